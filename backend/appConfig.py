@@ -33,6 +33,40 @@ leaderboard_settings = {
     "time_one_fire_window_sec": 60 * 4,
     "speedrunner_volume_boost": 1.5,
     "speedrunner_speed_boost": 0.7,
+    "time_on_fire_refresh_sec": 15,
+}
+
+evaluation_settings = {
+    "concurrent_injects": True,
+    "max_concurrent_injects": 8,  # Across all the messages being handled
+    "timed_inject_max_concurrent_users": 16,
+    "timed_inject_jitter_sec": 2,
+}
+
+# Handling of the ZMQ messages. `backpressure` is one of `block`, `drop_newest` or `drop_oldest`
+# Messages from topics not in `topics` (all topics if None) are ignored without being decoded. `markers` optionally maps
+# a topic to byte strings, one of which has to be in the message for it to be decoded
+ingest_settings = {
+    "workers": 4,
+    "queue_size": 1000,
+    "backpressure": "block",
+    "topics": ["misp_json_audit"],
+    "markers": {},
+}
+
+# Loop lag is sampled every `interval_sec`. Callbacks blocking the loop longer than `slow_callback_threshold_sec` have
+# their stack recorded, the last `max_slow_callbacks` are kept
+loop_monitor_settings = {
+    "interval_sec": 0.05,
+    "slow_callback_threshold_sec": 0.1,
+    "max_slow_callbacks": 100,
+    "lag_history_size": 1200,
+}
+
+# Clients built from src/ receive progress patches. A dist/ bundle built before them only understands the full
+# `update_progress` and `update_statistics` payloads, they are sent to such clients while `legacy_full_payloads` is set
+progress_settings = {
+    "legacy_full_payloads": True,
 }
 
 length = 16
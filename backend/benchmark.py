@@ -0,0 +1,370 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+from pathlib import Path
+from aiohttp import web
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backend.config as config
+import backend.db as db
+import backend.exercise as exercise_model
+import backend.misp_api as misp_api
+import backend.profiler as profiler
+import backend.sandboxClient as sandboxClient
+import backend.server as server
+from backend.appConfig import logger, ingest_settings
+from backend.ingest import IngestPipeline
+from backend.utils import get_version
+
+# Benchmark of the ingest-to-broadcast path: synthetic MISP audit logs are fed through the same filter, ingest pipeline
+# and handlers as the ZMQ messages, and synthetic payloads through the webhook handler. MISP and the sandbox agent are
+# replaced by local stand-ins serving the same endpoints.
+
+WORDS = [f"word{i}" for i in range(50)]
+REPORT_METRICS = [
+    ('zmq', 'p50'), ('zmq', 'p99'), ('zmq', 'throughput'),
+    ('webhook', 'p50'), ('webhook', 'p99'), ('webhook', 'throughput'),
+    ('loop_lag', 'max'), ('loop_lag', 'avg'),
+    ('memory', 'max_rss_mb'),
+]
+
+
+## Stand-ins
+def build_misp_standin(latency: float) -> web.Application:
+    async def handle(request):
+        await asyncio.sleep(latency)
+        path = request.path
+        if path.startswith('/events/view/'):
+            event_id = int(path.split('/')[-1])
+            return web.json_response({'Event': build_event(event_id)})
+        elif path.endswith('/restSearch') or path == '/events/index':
+            return web.json_response({'response': [{'Event': build_event(event_id)} for event_id in range(5)]})
+        elif path.startswith('/auth_keys/add/'):
+            return web.json_response({'AuthKey': {'authkey_raw': uuid.uuid4().hex}})
+        elif path.startswith('/servers/getVersion'):
+            return web.json_response({'version': '2.4.benchmark'})
+        return web.json_response({'message': 'Not found'}, status=404)
+
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', handle)
+    return app
+
+
+def build_event(event_id: int) -> dict:
+    generator = random.Random(event_id)
+    return {
+        'id': str(event_id),
+        'info': f"Benchmark event {' '.join(generator.sample(WORDS, 5))}",
+        'Attribute': [{'type': 'ip-dst', 'value': f"10.0.{event_id % 256}.{i}"} for i in range(10)],
+    }
+
+
+def build_sandbox_standin(latency: float) -> web.Application:
+    scripts = {}
+
+    async def register(request):
+        script = (await request.json())['script']
+        script_hash = sandboxClient.getScriptHash(script)
+        scripts[script_hash] = script
+        return web.json_response({'script_hash': script_hash})
+
+    async def evaluate(request):
+        script = scripts.get(request.query.get('script', ''), None)
+        if script is None:
+            return web.json_response({'error': 'Unknown script'}, status=404)
+        payload = await request.json()
+        await asyncio.sleep(latency)  # Container start and execution
+        namespace = {}
+        exec(compile(script, 'script.py', 'exec'), namespace)
+        outcome = namespace['evaluate'](payload['data'], payload['context']) is True
+        return web.json_response({'status': 'success', 'outcome': outcome, 'exit_code': 0, 'stdout': '', 'stderr': '', 'duration': latency})
+
+    async def stats(request):
+        return web.json_response({'pool_size': 0, 'standin': True})
+
+    app = web.Application()
+    app.router.add_post('/scripts', register)
+    app.router.add_post('/evaluate', evaluate)
+    app.router.add_get('/stats', stats)
+    return app
+
+
+# The stand-ins run in their own thread and event loop so that they do not weigh on the measured loop
+def start_standins(misp_latency: float, sandbox_latency: float) -> tuple:
+    ports = []
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        for app in [build_misp_standin(misp_latency), build_sandbox_standin(sandbox_latency)]:
+            runner = web.AppRunner(app, access_log=None)
+            loop.run_until_complete(runner.setup())
+            site = web.TCPSite(runner, '127.0.0.1', 0)
+            loop.run_until_complete(site.start())
+            ports.append(runner.addresses[0][1])
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return (ports[0], ports[1],)
+
+
+## Synthetic scenario
+def generate_exercises(directory: str, exercise_count: int, inject_count: int, python_ratio: float):
+    generator = random.Random(0)
+    for e in range(exercise_count):
+        injects = []
+        inject_flow = []
+        target_tool = 'webhook' if e == exercise_count - 1 and exercise_count > 1 else 'MISP'
+        for i in range(inject_count):
+            inject_uuid = str(uuid.UUID(int=(e + 1) * 100000 + i))
+            word = generator.choice(WORDS)
+            if target_tool == 'MISP' and generator.random() < python_ratio:
+                inject_evaluation = {
+                    'evaluation_strategy': 'python',
+                    'parameters': [f"return any('{word}' in entry['Event']['info'] for entry in data.get('response', []))"],
+                    'evaluation_context': {'query_context': {'request_method': 'POST', 'url': '/events/restSearch', 'payload': {'eventinfo': word}}},
+                }
+            elif target_tool == 'MISP':
+                inject_evaluation = {
+                    'evaluation_strategy': 'data_filtering',
+                    'parameters': [{'.Event.info': {'comparison': 'contains', 'values': [word]}}],
+                    'evaluation_context': {},
+                }
+            else:
+                inject_evaluation = {
+                    'evaluation_strategy': 'data_filtering',
+                    'parameters': [{'.value': {'comparison': 'equals', 'values': [word]}}],
+                    'evaluation_context': {},
+                }
+            inject_evaluation['score_range'] = [0, 10]
+            inject_evaluation['result'] = ''
+            injects.append({
+                'uuid': inject_uuid,
+                'name': f"Benchmark inject {e}-{i}",
+                'target_tool': target_tool,
+                'inject_evaluation_join_type': 'AND',
+                'inject_evaluation': [inject_evaluation],
+            })
+            inject_flow.append({'inject_uuid': inject_uuid, 'requirements': {}, 'sequence': {'followed_by': [], 'trigger': []}, 'timing': {}})
+        exercise = {
+            'exercise': {'uuid': str(uuid.UUID(int=1000 + e)), 'name': f"Benchmark exercise {e}", 'description': '', 'meta': {}},
+            'injects': injects,
+            'inject_flow': inject_flow,
+        }
+        with open(os.path.join(directory, f"exercise_{e}.json"), 'w') as f:
+            json.dump(exercise, f)
+
+
+def generate_audit_log(sequence: int, user_id: int, event_id: int) -> bytes:
+    log = {
+        'Log': {
+            'id': sequence,
+            'user_id': str(user_id),
+            'email': f"user{user_id}@benchmark.test",
+            'model': 'Event',
+            'model_id': event_id,
+            'action': 'edit',
+            'title': f"Event ({event_id}): edited",
+            'change': '',
+            'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+    }
+    return json.dumps(log).encode('utf-8')
+
+
+def generate_webhook_payload(user_id: int, generator: random.Random) -> dict:
+    return {
+        'user_id': user_id,
+        'email': f"user{user_id}@benchmark.test",
+        'target_tool': 'webhook',
+        'data': {'value': generator.choice(WORDS), '_secret': '__secret_key__'},
+    }
+
+
+## Measurements
+def summarize_latencies(latencies: list, elapsed: float) -> dict:
+    latencies = sorted(latencies)
+    count = len(latencies)
+    if count == 0:
+        return {'count': 0, 'throughput': 0}
+
+    def percentile(p):
+        return latencies[min(count - 1, int(p / 100 * count))]
+
+    return {
+        'count': count,
+        'throughput': count / max(elapsed, 1e-6),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': latencies[-1],
+        'avg': sum(latencies) / count,
+    }
+
+
+async def run_benchmark(args) -> dict:
+    misp_port, sandbox_port = start_standins(args.misp_latency, args.sandbox_latency)
+    config.misp_url = f"http://127.0.0.1:{misp_port}"
+    config.misp_apikey = 'benchmark'
+    config.misp_skipssl = True
+    sandboxClient.agent_url = f"http://127.0.0.1:{sandbox_port}"
+
+    exercise_directory = tempfile.mkdtemp(prefix='skillaegis_benchmark_')
+    generate_exercises(exercise_directory, args.exercises, args.injects, args.python_ratio)
+    exercise_model.ACTIVE_EXERCISES_DIR = Path(exercise_directory)
+    if not exercise_model.load_exercises():
+        raise RuntimeError('Could not load the generated exercises')
+    db.SELECTED_EXERCISES = [exercise['exercise']['uuid'] for exercise in exercise_model.get_all_exercises()]
+    db.bumpStateVersion()
+    if args.no_debounce:
+        exercise_model.check_active_tasks_debounced = exercise_model.check_active_tasks
+
+    zmq_started_at = {}
+    zmq_latencies = []
+
+    async def timed_handler(topic, data):
+        try:
+            await server.handleMessageData(topic, data)
+        finally:
+            started_at = zmq_started_at.pop(data['Log']['id'], None)
+            if started_at is not None:
+                zmq_latencies.append(time.perf_counter() - started_at)
+
+    server.INGEST_PIPELINE = IngestPipeline(timed_handler, server.get_message_shard_key, ingest_settings['workers'], ingest_settings['queue_size'], ingest_settings['backpressure'])
+    server.INGEST_PIPELINE.start()
+    lag_monitor = asyncio.ensure_future(server.monitor_loop_lag())
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    generator = random.Random(1)
+    webhook_latencies = []
+    webhook_semaphore = asyncio.Semaphore(args.webhook_concurrency)
+
+    async def send_webhook(payload):
+        async with webhook_semaphore:
+            started_at = time.perf_counter()
+            await server.handleWebhook(payload)
+            webhook_latencies.append(time.perf_counter() - started_at)
+
+    webhook_tasks = []
+    webhook_every = max(1, args.messages // args.webhooks) if args.webhooks > 0 else None
+    interval = 1 / args.rate if args.rate > 0 else 0
+    print(f"Feeding {args.messages} audit logs and {args.webhooks} webhooks for {args.users} users..")
+    started_at = time.perf_counter()
+    for sequence in range(args.messages):
+        user_id = generator.randint(1, args.users)
+        raw = generate_audit_log(sequence, user_id, generator.randint(1, 1000))
+        zmq_started_at[sequence] = time.perf_counter()
+        await server.ingestMessage('misp_json_audit', raw)
+        if webhook_every is not None and sequence % webhook_every == 0 and len(webhook_tasks) < args.webhooks:
+            webhook_tasks.append(asyncio.ensure_future(send_webhook(generate_webhook_payload(user_id, generator))))
+        if interval > 0:
+            await asyncio.sleep(interval)
+        elif sequence % 100 == 0:
+            await asyncio.sleep(0)
+    await asyncio.gather(*[queue.join() for queue in server.INGEST_PIPELINE.queues])
+    await asyncio.gather(*webhook_tasks)
+    elapsed = time.perf_counter() - started_at
+
+    lag_monitor.cancel()
+    await server.INGEST_PIPELINE.stop()
+    memory = {'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+    if args.tracemalloc:
+        memory['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+        tracemalloc.stop()
+    await misp_api.close_session()
+    await sandboxClient.close_session()
+
+    return {
+        'version': get_version(),
+        'timestamp': time.time(),
+        'parameters': vars(args),
+        'elapsed': elapsed,
+        'zmq': summarize_latencies(zmq_latencies, elapsed),
+        'webhook': summarize_latencies(webhook_latencies, elapsed),
+        'loop_lag': server.get_loop_lag_stats(),
+        'memory': memory,
+        'ingest': server.INGEST_PIPELINE.get_stats(),
+        'misp_fetch': misp_api.get_fetch_stats(),
+        'sandbox': {
+            'client': sandboxClient.getClientStats(),
+            'result_cache': sandboxClient.getResultCacheStats(),
+        },
+        'completed_tasks': count_completed_tasks(),
+        'inject_profiles': profiler.get_report(limit=20),
+    }
+
+
+def count_completed_tasks() -> int:
+    count = 0
+    for exercise_status in db.EXERCISES_STATUS.values():
+        for task in exercise_status['tasks'].values():
+            count += len(task['completed_by_user'])
+    return count
+
+
+def print_report(report: dict, baseline: dict = None):
+    print(f"Version {report['version']} - {report['elapsed']:.2f}s")
+    for section, metric in REPORT_METRICS:
+        value = report.get(section, {}).get(metric, None)
+        if value is None:
+            continue
+        line = f"  {section}.{metric}: {value:.4f}"
+        if baseline is not None:
+            baseline_value = baseline.get(section, {}).get(metric, None)
+            if baseline_value:
+                line += f"  (baseline {baseline_value:.4f}, {100 * (value - baseline_value) / baseline_value:+.1f}%)"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the handling of ZMQ messages and webhooks with local MISP and sandbox stand-ins.')
+    parser.add_argument('--users', type=int, default=300, help='Number of simulated users')
+    parser.add_argument('--exercises', type=int, default=3, help='Number of generated exercises. The last one targets the webhook tool')
+    parser.add_argument('--injects', type=int, default=10, help='Number of injects per exercise')
+    parser.add_argument('--python_ratio', type=float, default=0.2, help='Ratio of MISP injects evaluated with the python strategy')
+    parser.add_argument('--messages', type=int, default=5000, help='Number of audit logs to feed')
+    parser.add_argument('--webhooks', type=int, default=500, help='Number of webhook payloads to send')
+    parser.add_argument('--webhook_concurrency', type=int, default=20, help='Maximum number of webhook requests handled at the same time')
+    parser.add_argument('--rate', type=float, default=0, help='Audit logs per second. 0 feeds them as fast as possible')
+    parser.add_argument('--misp_latency', type=float, default=0.01, help='Response time of the MISP stand-in')
+    parser.add_argument('--sandbox_latency', type=float, default=0.05, help='Execution time of the sandbox stand-in')
+    parser.add_argument('--no_debounce', action='store_true', help='Check every audit log instead of debouncing them per user')
+    parser.add_argument('--verbose', action='store_true', help='Keep the info logs of the handlers')
+    parser.add_argument('--tracemalloc', action='store_true', help='Trace the allocated memory. Slows the benchmark down')
+    parser.add_argument('--output', type=str, default=None, help='Path of the JSON report')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON report of a previous run to compare against')
+    args = parser.parse_args()
+
+    if not args.verbose:
+        logger.setLevel(logging.WARNING)
+    report = asyncio.run(run_benchmark(args))
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
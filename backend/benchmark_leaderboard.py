@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backend.db as db
+import backend.leaderboard as leaderboard
+from backend.utils import get_version
+
+# Micro-benchmarks of the leaderboard and trophy computations over synthetic completion states.
+# Timings are compared against a baseline report and the run fails when one regresses beyond the tolerance.
+
+DEFAULT_USER_COUNTS = [10, 100, 1000, 5000]
+
+
+def generate_state(user_count: int, exercise_count: int, task_count: int, completion_ratio: float, seed: int = 0) -> tuple:
+    generator = random.Random(seed)
+    now = time.time()
+    db.USER_ID_TO_EMAIL_MAPPING = {}
+    db.EXERCISES_STATUS = {}
+    db.INJECT_BY_UUID = {}
+    db.NOTIFICATION_MESSAGES.clear()
+
+    for e in range(exercise_count):
+        exercise_uuid = str(uuid.UUID(int=1000 + e))
+        tasks = {}
+        for t in range(task_count):
+            task_uuid = str(uuid.UUID(int=(e + 1) * 100000 + t))
+            db.INJECT_BY_UUID[task_uuid] = {'uuid': task_uuid, 'inject_evaluation': [{'score_range': [0, 10]}]}
+            tasks[task_uuid] = {'name': f"Task {e}-{t}", 'uuid': task_uuid, 'completed_by_user': [], 'score': 10}
+        db.EXERCISES_STATUS[exercise_uuid] = {'uuid': exercise_uuid, 'name': f"Exercise {e}", 'tasks': tasks, 'max_score': 10 * task_count}
+
+    completion_for_users = {}
+    for user_id in range(1, user_count + 1):
+        db.USER_ID_TO_EMAIL_MAPPING[user_id] = f"user{user_id}@benchmark.test"
+        started_at = now - generator.uniform(0, 3 * 3600)
+        completion = {}
+        for exercise_status in db.EXERCISES_STATUS.values():
+            completion[exercise_status['uuid']] = {}
+            for task in exercise_status['tasks'].values():
+                entry = False
+                if generator.random() < completion_ratio:
+                    entry = {'user_id': user_id, 'timestamp': generator.uniform(started_at, now), 'first_completion': False}
+                    task['completed_by_user'].append(entry)
+                completion[exercise_status['uuid']][task['uuid']] = entry
+        completion_for_users[user_id] = completion
+
+    for i in range(db.NOTIFICATION_BUFFER_SIZE):  # Full feed, as during an exercise
+        user_id = generator.randint(1, user_count)
+        db.NOTIFICATION_MESSAGES.appendleft({
+            'id': i,
+            'notification_origin': 'webhook',
+            'target_tool': 'webhook',
+            'user_id': user_id,
+            'user': db.USER_ID_TO_EMAIL_MAPPING[user_id],
+            'message': {'text': None, 'variant': 'warning'},
+        })
+    db.bumpStateVersion()
+    return (list(db.EXERCISES_STATUS.keys()), completion_for_users,)
+
+
+def get_benchmarks(selected_exercises: list, completion_for_users: dict) -> dict:
+    benchmarks = {
+        'get_hall_of_fame': lambda: leaderboard.get_hall_of_fame(selected_exercises, completion_for_users),
+        'get_time_on_fire': lambda: leaderboard.get_time_on_fire(selected_exercises, completion_for_users),
+        'get_speed_runner': lambda: leaderboard.get_speed_runner(selected_exercises, completion_for_users),
+        'get_users_on_fire': lambda: leaderboard.get_users_on_fire(selected_exercises, completion_for_users),
+        'get_trophies': lambda: leaderboard.get_trophies(selected_exercises, completion_for_users),
+        'build_leaderboard_snapshot': lambda: leaderboard.build_leaderboard_snapshot(selected_exercises, completion_for_users),
+    }
+    for trophy in leaderboard.ALL_TROPHIES:
+        benchmarks[f"trophy.{trophy.id}"] = lambda trophy=trophy: trophy.is_earned_for_users(selected_exercises, completion_for_users)
+    return benchmarks
+
+
+# Runs `func` for at least `min_time` seconds and `min_rounds` rounds, after one warm-up round
+def measure(func, min_rounds: int, min_time: float) -> dict:
+    func()
+    timings = []
+    started_at = time.perf_counter()
+    while len(timings) < min_rounds or time.perf_counter() - started_at < min_time:
+        round_started_at = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - round_started_at)
+    return {
+        'rounds': len(timings),
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.mean(timings),
+        'max': max(timings),
+        'stddev': statistics.stdev(timings) if len(timings) > 1 else 0.0,
+    }
+
+
+def run_suite(args) -> dict:
+    results = {}
+    for user_count in args.users:
+        selected_exercises, completion_for_users = generate_state(user_count, args.exercises, args.tasks, args.completion_ratio)
+        results[str(user_count)] = {}
+        for name, func in get_benchmarks(selected_exercises, completion_for_users).items():
+            if args.filter is not None and args.filter not in name:
+                continue
+            result = measure(func, args.min_rounds, args.min_time)
+            results[str(user_count)][name] = result
+            print(f"{user_count:>6} users  {name:<32} median {1000 * result['median']:>10.3f}ms  min {1000 * result['min']:>10.3f}ms  ({result['rounds']} rounds)")
+    return results
+
+
+# Entries slower than the baseline by more than `tolerance` (relative to the baseline median)
+def find_regressions(results: dict, baseline: dict, tolerance: float) -> list:
+    regressions = []
+    for user_count, benchmarks in results.items():
+        for name, result in benchmarks.items():
+            baseline_result = baseline.get(user_count, {}).get(name, None)
+            if baseline_result is None:
+                continue
+            ratio = result['median'] / max(baseline_result['median'], 1e-9)
+            if ratio > 1 + tolerance:
+                regressions.append({
+                    'users': int(user_count),
+                    'name': name,
+                    'median': result['median'],
+                    'baseline_median': baseline_result['median'],
+                    'ratio': ratio,
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the leaderboard and trophy computations for various amounts of users.')
+    parser.add_argument('--users', type=int, nargs='+', default=DEFAULT_USER_COUNTS, help='Amounts of users to benchmark')
+    parser.add_argument('--exercises', type=int, default=3, help='Number of selected exercises')
+    parser.add_argument('--tasks', type=int, default=15, help='Number of tasks per exercise')
+    parser.add_argument('--completion_ratio', type=float, default=0.6, help='Ratio of completed tasks per user')
+    parser.add_argument('--filter', type=str, default=None, help='Only run the benchmarks whose name contains this string')
+    parser.add_argument('--min_rounds', type=int, default=5, help='Minimum number of rounds per benchmark')
+    parser.add_argument('--min_time', type=float, default=0.5, help='Minimum time spent per benchmark')
+    parser.add_argument('--output', type=str, default=None, help='Path of the JSON report')
+    parser.add_argument('--baseline', type=str, default=None, help='JSON report to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown of the median compared to the baseline')
+    args = parser.parse_args()
+
+    results = run_suite(args)
+    report = {
+        'version': get_version(),
+        'timestamp': time.time(),
+        'parameters': vars(args),
+        'results': results,
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Report saved to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline['results'], args.tolerance)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regression(s) compared to {args.baseline} ({baseline.get('version', 'unknown')}):")
+            for regression in regressions:
+                print(f"  {regression['users']:>6} users  {regression['name']:<32} {1000 * regression['baseline_median']:.3f}ms -> {1000 * regression['median']:.3f}ms ({regression['ratio']:.2f}x)")
+            sys.exit(1)
+        print(f"No regression compared to {args.baseline} ({baseline.get('version', 'unknown')})")
+
+
+if __name__ == '__main__':
+    main()
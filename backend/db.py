@@ -10,9 +10,17 @@ USER_ID_TO_AUTHKEY_MAPPING = {}
 ALL_EXERCISES = []
 SELECTED_EXERCISES = []
 INJECT_BY_UUID = {}
+INJECT_PLAN_BY_UUID = {}
+INJECT_ROUTING_INDEX = {}
 INJECT_SEQUENCE_BY_INJECT_UUID = {}
 INJECT_REQUIREMENTS_BY_INJECT_UUID = {}
 EXERCISES_STATUS = {}
+# user_id -> exercise_uuid -> task_uuid -> completion entry or False. Kept in sync by `exercise.mark_task_*`
+COMPLETION_BY_USER = {}
+# Monotonically increasing counter bumped whenever completion, selection or users change
+STATE_VERSION = 0
+# Value of STATE_VERSION when COMPLETION_BY_USER was last synced with the registered users
+COMPLETION_INDEX_VERSION = None
 
 NOTIFICATION_BUFFER_SIZE = 30
 NOTIFICATION_MESSAGES = collections.deque([], NOTIFICATION_BUFFER_SIZE)
@@ -31,6 +39,10 @@ USER_ACTIVITY = {}
 user_activity_buffer_size = USER_ACTIVITY_BUFFER_RESOLUTION_PER_MIN * USER_ACTIVITY_TIMESPAN_MIN
 
 
+def bumpStateVersion():
+   global STATE_VERSION
+   STATE_VERSION += 1
+
 def resetNotificationMessage():
    global NOTIFICATION_MESSAGES
    NOTIFICATION_MESSAGES = collections.deque([], NOTIFICATION_BUFFER_SIZE)
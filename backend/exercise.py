@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import asyncio
 import functools
 import time
 from pathlib import Path
@@ -8,20 +9,22 @@ import re
 from typing import Union
 import jq
 
-from backend.utils import debounce_check_active_tasks
+from backend.utils import debounce_check_active_tasks, pin_jq_program
 import backend.misp_api as misp_api
-from backend.appConfig import logger
+import backend.metrics as metrics
+import backend.profiler as profiler
+from backend.appConfig import logger, evaluation_settings
 import backend.config as config
 import backend.db as db
 import backend.leaderboard as leadboard
-
-from backend.target_tools.misp.exercise import inject_checker_router as inject_checker_router_misp
-from backend.target_tools.suricata.exercise import inject_checker_router as inject_checker_router_suricata
-from backend.target_tools.webhook.exercise import inject_checker_router as inject_checker_router_webhook
+from backend.inject_plan import compile_inject_plans, get_inject_plan, build_routing_index, get_candidate_injects, record_routing
 
 
 ACTIVE_EXERCISES_DIR = Path(config.exercise_directory)
 LAST_BACKUP = {}
+RUNNING_TIMED_INJECT_SWEEPS = set()
+# Shared by all the messages being handled, so that the limit holds across the ingest workers
+INJECT_EVALUATION_SEMAPHORE = asyncio.Semaphore(evaluation_settings['max_concurrent_injects'])
 
 
 def load_exercises() -> bool:
@@ -30,6 +33,8 @@ def load_exercises() -> bool:
         logger.error('Issue while validating exercises')
         return False
     init_inject_flow()
+    db.INJECT_PLAN_BY_UUID = compile_inject_plans(db.ALL_EXERCISES)
+    db.INJECT_ROUTING_INDEX = build_routing_index(db.INJECT_PLAN_BY_UUID)
     init_exercises_tasks()
     return True
 
@@ -88,6 +93,8 @@ def restore_exercices_progress():
 
     if len(db.EXERCISES_STATUS) == 0:
         init_exercises_tasks()
+    else:
+        rebuild_completion_index()
 
 
 def resetAll(wipeUsers=True):
@@ -129,7 +136,7 @@ def is_validate_exercises(exercises: list) -> bool:
                     for evaluation in inject_evaluation.get('parameters', []):
                         jq_path = list(evaluation.keys())[0]
                         try:
-                            jq.compile(jq_path)
+                            pin_jq_program(jq_path)
                         except ValueError as e:
                             logger.error(f"[{t_uuid} :: {inject['name']}] Could not compile jq path `{jq_path}`\n", e)
                             return False
@@ -175,6 +182,7 @@ def init_exercises_tasks():
             'tasks': tasks,
             'max_score': max_score,
         }
+    rebuild_completion_index()
 
 
 def get_exercises():
@@ -223,6 +231,7 @@ def change_exercise_selection(exercise_uuid: str, selected: bool):
     else:
         if exercise_uuid in db.SELECTED_EXERCISES:
             db.SELECTED_EXERCISES.remove(exercise_uuid)
+    db.bumpStateVersion()
 
     from backend.server import start_timed_injects
     start_timed_injects()
@@ -268,42 +277,74 @@ def get_incomplete_tasks_for_user(user_id: int):
 
 def get_available_tasks_for_user(user_id: int) -> list[str]:
     available_tasks = []
-    completed = get_completed_tasks_for_user(user_id)
-    incomplete = get_incomplete_tasks_for_user(user_id)
-    for exec_uuid, tasks in incomplete.items():
-        for task_uuid in tasks:
+    completion = get_completion_for_users().get(user_id, {})
+    for tasks_completion in completion.values():
+        for task_uuid, completed in tasks_completion.items():
+            if completed:
+                continue
             requirements = db.INJECT_REQUIREMENTS_BY_INJECT_UUID[task_uuid]
-            requirement_met = 'inject_uuid' not in requirements or requirements['inject_uuid'] in completed[exec_uuid]
+            requirement_met = 'inject_uuid' not in requirements or bool(tasks_completion.get(requirements['inject_uuid'], False))
             if requirement_met:
                 available_tasks.append(task_uuid)
     return available_tasks
 
 
 def get_completion_for_users() -> dict:
-    completion_per_user = {int(user_id): {} for user_id in db.USER_ID_TO_EMAIL_MAPPING.keys()}
-    for exercise_status in db.EXERCISES_STATUS.values():
-        for user_id in completion_per_user.keys():
-            completion_per_user[int(user_id)][exercise_status['uuid']] = {}
+    # The index is maintained incrementally. Users are only synced when the state changed since the last sync.
+    if db.COMPLETION_INDEX_VERSION != db.STATE_VERSION:
+        sync_completion_index()
+    return db.COMPLETION_BY_USER
+
+
+def rebuild_completion_index():
+    db.COMPLETION_BY_USER = {}
+    db.bumpStateVersion()
+    sync_completion_index()
 
+
+def sync_completion_index():
+    user_ids = {int(user_id) for user_id in db.USER_ID_TO_EMAIL_MAPPING.keys()}
+    changed = False
+    for user_id in list(db.COMPLETION_BY_USER.keys()):
+        if user_id not in user_ids:
+            del db.COMPLETION_BY_USER[user_id]
+            changed = True
+    for user_id in user_ids:
+        if user_id not in db.COMPLETION_BY_USER:
+            db.COMPLETION_BY_USER[user_id] = build_completion_for_user(user_id)
+            changed = True
+    if changed:
+        db.bumpStateVersion()
+    db.COMPLETION_INDEX_VERSION = db.STATE_VERSION
+
+
+def build_completion_for_user(user_id: int) -> dict:
+    completion = {}
+    for exercise_status in db.EXERCISES_STATUS.values():
+        completion[exercise_status['uuid']] = {}
         for task in exercise_status['tasks'].values():
-            for user_id in completion_per_user.keys():
-                completion_per_user[int(user_id)][exercise_status['uuid']][task['uuid']] = False
-            for entry in task['completed_by_user']:
-                user_id = int(entry['user_id'])
-                if user_id in completion_per_user:  # Ensure the user_id is known in USER_ID_TO_EMAIL_MAPPING
-                    completion_per_user[user_id][exercise_status['uuid']][task['uuid']] = entry
+            entry = next((entry for entry in task['completed_by_user'] if int(entry['user_id']) == user_id), False)
+            completion[exercise_status['uuid']][task['uuid']] = entry
+    return completion
 
-    return completion_per_user
+
+def update_completion_index(user_id: int, exercise_uuid: str, task_uuid: str, entry: Union[dict, bool]):
+    if user_id in db.COMPLETION_BY_USER:
+        db.COMPLETION_BY_USER[user_id].setdefault(exercise_uuid, {})[task_uuid] = entry
+    db.bumpStateVersion()
 
 
 def mark_task_completed(user_id: int, exercise_uuid: str , task_uuid: str):
-    is_completed  = any(filter(lambda x: x['user_id'] == user_id, db.EXERCISES_STATUS[exercise_uuid]['tasks'][task_uuid]['completed_by_user']))
-    if not is_completed:
-        db.EXERCISES_STATUS[exercise_uuid]['tasks'][task_uuid]['completed_by_user'].append({
+    completed_by_user = db.EXERCISES_STATUS[exercise_uuid]['tasks'][task_uuid]['completed_by_user']
+    entry = next(filter(lambda x: x['user_id'] == user_id, completed_by_user), None)
+    if entry is None:
+        entry = {
             'user_id': user_id,
             'timestamp': time.time(),
             'first_completion': False,
-        })
+        }
+        completed_by_user.append(entry)
+    update_completion_index(user_id, exercise_uuid, task_uuid, entry)
     # Update who was the first to complete the task
     first_completion_index = None
     first_completion_time = time.time()
@@ -318,6 +359,7 @@ def mark_task_completed(user_id: int, exercise_uuid: str , task_uuid: str):
 def mark_task_incomplete(user_id: int, exercise_uuid: str , task_uuid: str):
     completed_without_user = list(filter(lambda x: x['user_id'] != user_id, db.EXERCISES_STATUS[exercise_uuid]['tasks'][task_uuid]['completed_by_user']))
     db.EXERCISES_STATUS[exercise_uuid]['tasks'][task_uuid]['completed_by_user'] = completed_without_user
+    update_completion_index(user_id, exercise_uuid, task_uuid, False)
 
 
 def get_progress():
@@ -332,7 +374,7 @@ def get_progress():
             'email': db.USER_ID_TO_EMAIL_MAPPING[user_id],
             'user_id': user_id,
             'exercises': {},
-            'status': leadboard.get_user_status(user_id, selected_exercices, get_completion_for_users())
+            'status': leadboard.get_user_status(user_id, selected_exercices, completion_for_users)
         }
         for exec_uuid, tasks_completion in completion_for_users[user_id].items():
             if exec_uuid in selected_exercices:
@@ -350,122 +392,235 @@ def get_users_stats() -> dict:
     return leadboard.get_user_stats(selected_exercices, completion_for_users)
 
 
-@debounce_check_active_tasks(debounce_seconds=2)
+async def refresh_score_after_trailing_check(succeeded_once: bool):
+    if succeeded_once:
+        from backend.server import sendRefreshScore
+        await sendRefreshScore()
+
+
+async def submit_trailing_check(user_id: int, run_trailing, *args):
+    from backend.server import INGEST_PIPELINE
+    if INGEST_PIPELINE is None:
+        await run_trailing(*args)
+    else:
+        await INGEST_PIPELINE.submit_call(user_id, run_trailing, *args)  # Ordered with the user's messages
+
+
+@debounce_check_active_tasks(debounce_seconds=2, on_trailing_result=refresh_score_after_trailing_check, submit_trailing=submit_trailing_check)
 async def check_active_tasks_debounced(user_id: int, data: dict, context: dict, for_target_tool: Union[str, None] = None) -> bool:
     return await check_active_tasks(user_id, data, context, for_target_tool)
 
 
 async def check_active_tasks(user_id: int, data: dict, context: dict, for_target_tool: Union[str, None] = None) -> bool:
-    succeeded_once = False
+    with misp_api.fetch_scope():  # Injects checked for the same message share their fetches
+        return await check_candidate_tasks(user_id, data, context, for_target_tool)
+
+
+async def check_candidate_tasks(user_id: int, data: dict, context: dict, for_target_tool: Union[str, None] = None) -> bool:
     available_tasks = get_available_tasks_for_user(user_id)
+    candidates = get_candidate_injects(for_target_tool, data) if for_target_tool is not None else None
+    injects_to_check = []
+    skipped_count = 0
     for task_uuid in available_tasks:
         inject = db.INJECT_BY_UUID[task_uuid]
         if inject['exercise_uuid'] not in db.SELECTED_EXERCISES:
             continue
-        logger.debug(f"[{task_uuid}] :: checking: {inject['name']}")
+        if candidates is not None and task_uuid not in candidates:
+            skipped_count += 1
+            continue
+        injects_to_check.append(inject)
+    record_routing(len(injects_to_check), skipped_count)
+
+    if evaluation_settings['concurrent_injects'] and len(injects_to_check) > 1:
+        return await check_injects_concurrently(user_id, injects_to_check, data, context, for_target_tool)
+
+    succeeded_once = False
+    for inject in injects_to_check:
+        logger.debug(f"[{inject['uuid']}] :: checking: {inject['name']}")
         completed = await check_inject(user_id, inject, data, context, for_target_tool)
         if completed:
             succeeded_once = True
     return succeeded_once
 
 
+async def check_injects_concurrently(user_id: int, injects: list, data: dict, context: dict, for_target_tool: Union[str, None] = None) -> bool:
+    async def evaluate_with_limit(inject: dict) -> bool:
+        async with INJECT_EVALUATION_SEMAPHORE:
+            logger.debug(f"[{inject['uuid']}] :: checking: {inject['name']}")
+            return await evaluate_inject(user_id, inject, data, context, for_target_tool, concurrent=True)
+
+    outcomes = await asyncio.gather(*[evaluate_with_limit(inject) for inject in injects], return_exceptions=True)
+
+    # Completions are recorded in the order of the available tasks, regardless of which evaluation finished first.
+    # As in the sequential mode, an error is raised once the completions of the other injects are recorded
+    succeeded_once = False
+    first_error = None
+    for inject, outcome in zip(injects, outcomes):
+        if isinstance(outcome, BaseException):
+            first_error = first_error if first_error is not None else outcome
+        elif outcome:
+            mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
+            logger.info(f"Task success[{user_id}]: {inject['uuid']}")
+            succeeded_once = True
+    if first_error is not None:
+        raise first_error
+    return succeeded_once
+
+
 async def check_inject(user_id: int, inject: dict, data: dict, context: dict, for_target_tool: Union[str, None] = None) -> bool:
+    completed = await evaluate_inject(user_id, inject, data, context, for_target_tool)
+    if completed:
+        mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
+        logger.info(f"Task success[{user_id}]: {inject['uuid']}")
+    return completed
+
+
+async def evaluate_inject(user_id: int, inject: dict, data: dict, context: dict, for_target_tool: Union[str, None] = None, concurrent: bool = False) -> bool:
     from backend.server import sendUserInjectCheckInProgress
 
-    inject_evaluation_join_type = inject.get('inject_evaluation_join_type', 'UNDEFINED')
-    for_target_tool = for_target_tool if for_target_tool is not None else inject['target_tool']
-    if inject['target_tool'] == 'MISP' and inject['target_tool'] == for_target_tool:
-        inject_checker_router = inject_checker_router_misp
-    elif inject['target_tool'] == 'suricata' and inject['target_tool'] == for_target_tool:
-        inject_checker_router = inject_checker_router_suricata
-    elif inject['target_tool'] == 'webhook' and inject['target_tool'] == for_target_tool:
-        inject_checker_router = inject_checker_router_webhook
-    else:
+    plan = get_inject_plan(inject)
+    for_target_tool = for_target_tool if for_target_tool is not None else plan.target_tool
+    if plan.checker is None or plan.target_tool != for_target_tool:
         return False
+    if concurrent and len(plan.evaluations) > 1:
+        return await evaluate_inject_concurrently(user_id, inject, plan, data, context)
 
     successCount = 0
-    for inject_evaluation in inject['inject_evaluation']:
+    for evaluation in plan.evaluations:
         await sendUserInjectCheckInProgress(user_id, inject['uuid'])
-        success = await inject_checker_router(user_id, inject_evaluation, data, context)
-        if not success and inject_evaluation_join_type == 'AND':
+        success = await run_checker(plan, user_id, evaluation, data, context)
+        if not success and plan.join_type == 'AND':
             logger.info(f"Task not completed[{user_id}]: {inject['uuid']}. failure of one inject and join type is `AND`")
             return False
         elif success:
             successCount += 1
-            if inject_evaluation_join_type == 'OR':
-                mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
-                logger.info(f"Task success[{user_id}]: {inject['uuid']}")
-                return True
-            elif successCount == len(inject['inject_evaluation']):
-                mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
-                logger.info(f"Task success[{user_id}]: {inject['uuid']}")
+            if plan.join_type == 'OR' or successCount == len(plan.evaluations):
                 return True
     logger.info(f"Task not completed[{user_id}]: {inject['uuid']}. failure of all injects")
     return False
 
 
-async def check_inject_for_timed_inject(inject: dict, data: dict, context: dict) -> bool:
+async def run_checker(plan, user_id: int, evaluation, data: dict, context: dict) -> bool:
+    start_time = time.perf_counter()
+    try:
+        with profiler.profile_evaluation(plan.uuid, evaluation.strategy, 'evaluation_trigger' in context) as profile:
+            try:
+                profile['outcome'] = await plan.checker(user_id, evaluation, data, context)
+            except asyncio.CancelledError:
+                profile['outcome'] = 'cancelled'
+                raise
+            except Exception:
+                profile['outcome'] = 'error'
+                raise
+            return profile['outcome']
+    finally:
+        metrics.INJECT_CHECK_DURATION.observe(time.perf_counter() - start_time, strategy=evaluation.strategy, target_tool=plan.target_tool)
+
+
+async def evaluate_inject_concurrently(user_id: int, inject: dict, plan, data: dict, context: dict) -> bool:
     from backend.server import sendUserInjectCheckInProgress
 
-    inject_evaluation_join_type = inject.get('inject_evaluation_join_type', 'UNDEFINED')
-    if inject['target_tool'] == 'MISP':
-        inject_checker_router = inject_checker_router_misp
-    elif inject['target_tool'] == 'suricata':
-        inject_checker_router = inject_checker_router_suricata
-    elif inject["target_tool"] == "webhook":
-        inject_checker_router = inject_checker_router_webhook
-    else:
+    async def run_evaluation(evaluation) -> bool:
+        await sendUserInjectCheckInProgress(user_id, inject['uuid'])
+        return await run_checker(plan, user_id, evaluation, data, context)
+
+    evaluation_tasks = [asyncio.ensure_future(run_evaluation(evaluation)) for evaluation in plan.evaluations]
+    successCount = 0
+    try:
+        for next_evaluation in asyncio.as_completed(evaluation_tasks):
+            success = await next_evaluation
+            if success:
+                successCount += 1
+                if plan.join_type == 'OR' or successCount == len(evaluation_tasks):
+                    return True
+            elif plan.join_type != 'OR':  # Every evaluation has to succeed, no need to wait for the others
+                logger.info(f"Task not completed[{user_id}]: {inject['uuid']}. failure of one inject and join type is `{plan.join_type}`")
+                return False
+    finally:
+        for evaluation_task in evaluation_tasks:
+            if not evaluation_task.done():
+                evaluation_task.cancel()
+    logger.info(f"Task not completed[{user_id}]: {inject['uuid']}. failure of all injects")
+    return False
+
+
+async def check_inject_for_timed_inject(inject: dict, data: dict, context: dict) -> bool:
+    if inject['uuid'] in RUNNING_TIMED_INJECT_SWEEPS:
+        logger.info(f"Timed inject {inject['uuid']} is still being checked. Skipping this run")
         return False
 
-    at_last_one_success = False
-    user_ids = list(db.USER_ID_TO_EMAIL_MAPPING.keys())
-    for user_id in user_ids:
+    RUNNING_TIMED_INJECT_SWEEPS.add(inject['uuid'])
+    try:
+        with misp_api.fetch_scope():  # Identical queries of a user are fetched once per sweep
+            return await sweep_timed_inject(inject, data, context)
+    finally:
+        RUNNING_TIMED_INJECT_SWEEPS.discard(inject['uuid'])
+
 
+async def sweep_timed_inject(inject: dict, data: dict, context: dict) -> bool:
+    plan = get_inject_plan(inject)
+    if plan.checker is None:
+        return False
+
+    user_ids = []
+    for user_id in list(db.USER_ID_TO_EMAIL_MAPPING.keys()):
         if not is_user_email_known(user_id):
             logger.info(f"User[{user_id}] email is not unknown.")
             continue
+        if inject['uuid'] not in get_available_tasks_for_user(user_id):
+            continue
+        user_ids.append(user_id)
+    if len(user_ids) == 0:
+        return False
 
-        fullContext = dict(context)
-        fullContext['user_id'] = user_id
-        fullContext['user_email'] = db.USER_ID_TO_EMAIL_MAPPING.get(user_id, None)
-        fullContext['user_authkey'] = db.USER_ID_TO_AUTHKEY_MAPPING.get(user_id, None)
+    semaphore = asyncio.Semaphore(evaluation_settings['timed_inject_max_concurrent_users'])
 
-        successCount = 0
-        completed = False
-        available_tasks = get_available_tasks_for_user(user_id)
-        if inject['uuid'] not in available_tasks:
-            continue
+    async def evaluate_with_limit(user_id: int) -> bool:
+        async with semaphore:
+            return await evaluate_timed_inject_for_user(user_id, inject, plan, data, context)
 
-        for inject_evaluation in inject['inject_evaluation']:
-
-            if inject_evaluation["evaluation_strategy"] not in ['query_search', 'python']:
-                if inject_evaluation_join_type == 'AND':
-                    logger.info(f"Unsupported evaluation_strategy `{inject_evaluation['evaluation_strategy']}` and evaluation join type `{inject_evaluation_join_type}` for Timed inject")
-                    break
-                elif inject_evaluation_join_type == 'OR':
-                    continue
-
-            await sendUserInjectCheckInProgress(user_id, inject['uuid'])
-            success = await inject_checker_router(user_id, inject_evaluation, data, fullContext)
-            if not success and inject_evaluation_join_type == 'AND':
-                mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
-                logger.info(f"Task success[{user_id}]: {inject['uuid']}")
-                completed = True
-                break
-            elif success:
-                successCount += 1
-                if inject_evaluation_join_type == 'OR':
-                    mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
-                    logger.info(f"Task success[{user_id}]: {inject['uuid']}")
-                    completed = True
-                    break
-                elif successCount == len(inject['inject_evaluation']):
-                    mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
-                    logger.info(f"Task success[{user_id}]: {inject['uuid']}")
-                    completed = True
-                    break
-        if not completed:
-            logger.info(f"Task not completed[{user_id}]: {inject['uuid']}. failure of all injects")
-        else:
+    start_time = time.time()
+    outcomes = await asyncio.gather(*[evaluate_with_limit(user_id) for user_id in user_ids], return_exceptions=True)
+    logger.debug(f"[{inject['uuid']}] :: timed inject checked for {len(user_ids)} users in {time.time() - start_time:.3f}s")
+
+    at_last_one_success = False
+    for user_id, outcome in zip(user_ids, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"Error while checking[{user_id}]: {inject['uuid']}. {outcome}")
+        elif outcome:
+            mark_task_completed(user_id, inject['exercise_uuid'], inject['uuid'])
+            logger.info(f"Task success[{user_id}]: {inject['uuid']}")
             at_last_one_success = True
+        else:
+            logger.info(f"Task not completed[{user_id}]: {inject['uuid']}. failure of all injects")
     return at_last_one_success
+
+
+async def evaluate_timed_inject_for_user(user_id: int, inject: dict, plan, data: dict, context: dict) -> bool:
+    from backend.server import sendUserInjectCheckInProgress
+
+    fullContext = dict(context)
+    fullContext['user_id'] = user_id
+    fullContext['user_email'] = db.USER_ID_TO_EMAIL_MAPPING.get(user_id, None)
+    fullContext['user_authkey'] = db.USER_ID_TO_AUTHKEY_MAPPING.get(user_id, None)
+
+    successCount = 0
+    for inject_evaluation in plan.evaluations:
+
+        if inject_evaluation.strategy not in ['query_search', 'python']:
+            if plan.join_type == 'AND':
+                logger.info(f"Unsupported evaluation_strategy `{inject_evaluation['evaluation_strategy']}` and evaluation join type `{plan.join_type}` for Timed inject")
+                return False
+            elif plan.join_type == 'OR':
+                continue
+
+        await sendUserInjectCheckInProgress(user_id, inject['uuid'])
+        success = await run_checker(plan, user_id, inject_evaluation, data, fullContext)
+        if not success and plan.join_type == 'AND':
+            logger.info(f"Task not completed[{user_id}]: {inject['uuid']}. failure of one inject and join type is `AND`")
+            return False
+        elif success:
+            successCount += 1
+            if plan.join_type == 'OR' or successCount == len(plan.evaluations):
+                return True
+    return False
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import asyncio
+import json
+import time
+from typing import Callable, Union
+
+from backend.appConfig import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BACKPRESSURE_POLICIES = ['block', 'drop_newest', 'drop_oldest']
+
+
+def decode_json(raw: bytes):
+    if orjson is not None:
+        try:
+            return orjson.loads(raw)
+        except orjson.JSONDecodeError:
+            pass  # Stricter than json, e.g. on NaN or very large integers
+    return json.loads(raw)
+
+
+# Rejects messages before they are decoded. Only topics in `allowed_topics` are accepted (all if None), and for topics
+# having `markers`, the raw message must contain at least one of them.
+class MessageFilter:
+
+    def __init__(self, allowed_topics: Union[list, None] = None, markers: Union[dict, None] = None):
+        self.allowed_topics = set(allowed_topics) if allowed_topics is not None else None
+        self.markers = {topic: [marker.encode('utf-8') if isinstance(marker, str) else marker for marker in topic_markers] for topic, topic_markers in (markers or {}).items()}
+        self.started_at = time.time()
+        self.topic_stats = {}
+
+    def accept(self, topic: str, raw: bytes) -> bool:
+        stats = self.topic_stats.get(topic, None)
+        if stats is None:
+            stats = {'messages': 0, 'bytes': 0, 'accepted': 0, 'rejected_topic': 0, 'rejected_marker': 0}
+            self.topic_stats[topic] = stats
+        stats['messages'] += 1
+        stats['bytes'] += len(raw)
+        if self.allowed_topics is not None and topic not in self.allowed_topics:
+            stats['rejected_topic'] += 1
+            return False
+        topic_markers = self.markers.get(topic, None)
+        if topic_markers is not None and not any(marker in raw for marker in topic_markers):
+            stats['rejected_marker'] += 1
+            return False
+        stats['accepted'] += 1
+        return True
+
+    def get_stats(self) -> dict:
+        elapsed = max(1, time.time() - self.started_at)
+        stats = {}
+        for topic, topic_stats in self.topic_stats.items():
+            stats[topic] = dict(topic_stats)
+            stats[topic]['messages_per_sec'] = topic_stats['messages'] / elapsed
+            stats[topic]['bytes_per_sec'] = topic_stats['bytes'] / elapsed
+        return {
+            'decoder': 'orjson' if orjson is not None else 'json',
+            'allowed_topics': sorted(self.allowed_topics) if self.allowed_topics is not None else None,
+            'topics': stats,
+        }
+
+
+# Messages are dispatched to one queue per worker based on their shard key, so that messages
+# of the same user are handled in order while different users are handled concurrently.
+class IngestPipeline:
+
+    def __init__(self, handler: Callable, shard_key: Callable, workers: int = 4, queue_size: int = 1000, backpressure: str = 'block'):
+        if backpressure not in BACKPRESSURE_POLICIES:
+            raise ValueError(f"Unknown backpressure policy `{backpressure}`. Valid policies: {BACKPRESSURE_POLICIES}")
+        self.handler = handler
+        self.shard_key = shard_key
+        self.worker_count = workers
+        self.queue_size = queue_size
+        self.backpressure = backpressure
+        self.queues = []
+        self.workers = []
+        self.stats = {
+            'received': 0,
+            'processed': 0,
+            'dropped': 0,
+            'errors': 0,
+            'blocked': 0,
+            'max_depth': 0,
+            'last_lag': 0.0,
+            'max_lag': 0.0,
+            'total_lag': 0.0,
+        }
+
+    def start(self):
+        shard_size = max(1, self.queue_size // self.worker_count)
+        self.queues = [asyncio.Queue(maxsize=shard_size) for i in range(self.worker_count)]
+        self.workers = [asyncio.ensure_future(self.work(queue)) for queue in self.queues]
+
+    async def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def submit(self, *args):
+        await self.enqueue(self.get_shard(args), self.handler, args)
+
+    # Runs `func(*args)` on the worker of `key` once the messages already queued for it are handled
+    async def submit_call(self, key, func: Callable, *args):
+        await self.enqueue(self.get_shard_for_key(key), func, args)
+
+    async def enqueue(self, shard: int, func: Callable, args: tuple):
+        self.stats['received'] += 1
+        queue = self.queues[shard]
+        item = (time.time(), func, args,)
+        if queue.full():
+            if self.backpressure == 'drop_newest':
+                self.stats['dropped'] += 1
+                return
+            elif self.backpressure == 'drop_oldest':
+                queue.get_nowait()
+                queue.task_done()
+                self.stats['dropped'] += 1
+            else:
+                self.stats['blocked'] += 1  # Stop receiving until the worker catches up
+        await queue.put(item)
+        self.stats['max_depth'] = max(self.stats['max_depth'], queue.qsize())
+
+    def get_shard(self, args: tuple) -> int:
+        try:
+            key = self.shard_key(*args)
+        except Exception:
+            key = None
+        return self.get_shard_for_key(key)
+
+    def get_shard_for_key(self, key) -> int:
+        return 0 if key is None else hash(key) % self.worker_count
+
+    async def work(self, queue: asyncio.Queue):
+        while True:
+            enqueued_at, func, args = await queue.get()
+            lag = time.time() - enqueued_at
+            self.stats['last_lag'] = lag
+            self.stats['max_lag'] = max(self.stats['max_lag'], lag)
+            self.stats['total_lag'] += lag
+            try:
+                await func(*args)
+            except Exception as e:
+                self.stats['errors'] += 1
+                logger.error('Error handling message %s', e)
+            finally:
+                self.stats['processed'] += 1
+                queue.task_done()
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats['workers'] = self.worker_count
+        stats['backpressure'] = self.backpressure
+        stats['depth'] = [queue.qsize() for queue in self.queues]
+        stats['avg_lag'] = stats['total_lag'] / max(1, stats['processed'])
+        return stats
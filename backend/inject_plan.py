@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+import json
+
+import backend.db as db
+from backend.utils import Template, compile_conditions
+
+from backend.target_tools.misp.exercise import inject_checker_router as inject_checker_router_misp
+from backend.target_tools.misp.exercise import get_message_route as get_message_route_misp
+from backend.target_tools.misp.exercise import get_evaluation_routes as get_evaluation_routes_misp
+from backend.target_tools.suricata.exercise import inject_checker_router as inject_checker_router_suricata
+from backend.target_tools.webhook.exercise import inject_checker_router as inject_checker_router_webhook
+
+
+INJECT_CHECKER_ROUTERS = {
+    'MISP': inject_checker_router_misp,
+    'suricata': inject_checker_router_suricata,
+    'webhook': inject_checker_router_webhook,
+}
+
+# Tools not listed here react to any message
+MESSAGE_ROUTERS = {
+    'MISP': get_message_route_misp,
+}
+EVALUATION_ROUTERS = {
+    'MISP': get_evaluation_routes_misp,
+}
+
+INJECT_ROUTING_STATS = {
+    'messages': 0,
+    'checked': 0,
+    'skipped': 0,
+}
+
+# Strategies for which the `parameters` are a list of `{jq_path: condition}`
+FILTERING_STRATEGIES = ['data_filtering', 'query_search', 'misp_query_search', 'simulate_ips']
+
+
+# An inject evaluation with its conditions compiled. It behaves as the original dict for the checker routers
+class EvaluationPlan(dict):
+    __slots__ = ('strategy', 'conditions', 'query_context_template')
+
+    def __init__(self, inject_evaluation: dict):
+        super().__init__(inject_evaluation)
+        self.strategy = inject_evaluation.get('evaluation_strategy', None)
+        self.conditions = None
+        self.query_context_template = None
+        if self.strategy in FILTERING_STRATEGIES:
+            self.conditions = compile_conditions(inject_evaluation.get('parameters', []))
+        query_context = inject_evaluation.get('evaluation_context', {}).get('query_context', None)
+        if self.strategy == 'misp_query_search' and query_context is not None:
+            self.query_context_template = Template(json.dumps(query_context))
+
+
+class InjectPlan:
+    __slots__ = ('uuid', 'name', 'exercise_uuid', 'target_tool', 'join_type', 'checker', 'evaluations', 'routes')
+
+    def __init__(self, inject: dict):
+        self.uuid = inject['uuid']
+        self.name = inject['name']
+        self.exercise_uuid = inject.get('exercise_uuid', None)
+        self.target_tool = inject.get('target_tool', None)
+        self.join_type = inject.get('inject_evaluation_join_type', 'UNDEFINED')
+        self.checker = INJECT_CHECKER_ROUTERS.get(self.target_tool, None)
+        self.evaluations = [EvaluationPlan(inject_evaluation) for inject_evaluation in inject.get('inject_evaluation', [])]
+        self.routes = get_inject_routes(self)
+
+
+def get_inject_routes(plan: InjectPlan) -> set:
+    evaluation_router = EVALUATION_ROUTERS.get(plan.target_tool, lambda inject_evaluation: {'*'})
+    evaluations_routes = [evaluation_router(evaluation) for evaluation in plan.evaluations]
+    if plan.join_type == 'OR':  # A single evaluation has to succeed
+        return set().union(*evaluations_routes)
+
+    # Otherwise all evaluations have to succeed on the same message
+    routes = {'*'}
+    for evaluation_routes in evaluations_routes:
+        intersected_routes = set()
+        for route1 in routes:
+            for route2 in evaluation_routes:
+                route = intersect_routes(route1, route2)
+                if route is not None:
+                    intersected_routes.add(route)
+        routes = intersected_routes
+    if len(routes) == 0:  # Steps routed on different kinds of messages, do not risk never checking the inject
+        return set().union(*evaluations_routes)
+    return routes
+
+
+def intersect_routes(route1, route2):
+    if route1 == '*':
+        return route2
+    if route2 == '*':
+        return route1
+    if route1[0] != route2[0]:
+        return None
+    if route1[1] == '*':
+        return route2
+    if route2[1] == '*':
+        return route1
+    return route1 if route1 == route2 else None
+
+
+def compile_inject_plans(exercises: list) -> dict:
+    plans = {}
+    for exercise in exercises:
+        for inject in exercise['injects']:
+            plans[inject['uuid']] = InjectPlan(inject)
+    return plans
+
+
+# target_tool -> route -> inject uuids that could succeed on a message with that route
+def build_routing_index(plans: dict) -> dict:
+    index = {}
+    for plan in plans.values():
+        for route in plan.routes:
+            index.setdefault(plan.target_tool, {}).setdefault(route, set()).add(plan.uuid)
+    return index
+
+
+def get_candidate_injects(target_tool: str, data: dict) -> set:
+    index = db.INJECT_ROUTING_INDEX.get(target_tool, {})
+    candidates = set(index.get('*', set()))
+    if target_tool in MESSAGE_ROUTERS:
+        kind, scope = MESSAGE_ROUTERS[target_tool](data)
+        if kind is not None:
+            candidates |= index.get((kind, '*',), set())
+            candidates |= index.get((kind, scope,), set())
+    return candidates
+
+
+def record_routing(checked: int, skipped: int):
+    INJECT_ROUTING_STATS['messages'] += 1
+    INJECT_ROUTING_STATS['checked'] += checked
+    INJECT_ROUTING_STATS['skipped'] += skipped
+
+
+def get_routing_stats() -> dict:
+    return dict(INJECT_ROUTING_STATS)
+
+
+def get_inject_plan(inject: dict) -> InjectPlan:
+    plan = db.INJECT_PLAN_BY_UUID.get(inject['uuid'], None)
+    if plan is None:
+        plan = InjectPlan(inject)
+        db.INJECT_PLAN_BY_UUID[inject['uuid']] = plan
+    return plan
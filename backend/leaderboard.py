@@ -13,6 +13,8 @@ ALL_TROPHIES = [
     # Other trophies can be defined in individual scenarios
 ]
 
+LEADERBOARD_SNAPSHOT = None
+
 
 def get_score_for_task_completion(tasks_completion: dict) -> int:
     score = 0
@@ -73,6 +75,10 @@ def get_speed_runner(selected_exercices: list, completion_for_users: dict) -> li
 
 
 def get_user_stats(selected_exercices: list, completion_for_users: dict) -> dict:
+    return get_leaderboard_snapshot(selected_exercices, completion_for_users)["user_stats"]
+
+
+def compute_user_stats(selected_exercices: list, completion_for_users: dict) -> dict:
     return {
         "hall_of_fame": get_hall_of_fame(selected_exercices, completion_for_users),
         "time_on_fire": get_time_on_fire(selected_exercices, completion_for_users),
@@ -82,22 +88,75 @@ def get_user_stats(selected_exercices: list, completion_for_users: dict) -> dict
 
 
 def get_user_status(user_id: int, selected_exercices: list, completion_for_users: dict) -> dict:
-    user_stats = get_user_stats(selected_exercices, completion_for_users)
-    users_on_fire = get_users_on_fire(selected_exercices, completion_for_users)
-    users_trophies = get_trophies(selected_exercices, completion_for_users)
-    collected_trophies = []
-    for trophy in users_trophies.values():
-        for user in trophy['users']:
-            if user['user_id'] == user_id:
-                collected_trophies.append(trophy['metadata'])
+    snapshot = get_leaderboard_snapshot(selected_exercices, completion_for_users)
+    status = snapshot["status_by_user"].get(user_id, None)
+    if status is None:
+        status = build_user_status(user_id, snapshot)
+    return status
+
+
+# The snapshot is keyed on its inputs and on `db.STATE_VERSION`, which is bumped whenever the completion, the selection
+# or the users change. Notifications only invalidate it when the holders of a notification based trophy change.
+# It also expires with time as being on fire depends on the current time.
+def get_leaderboard_snapshot(selected_exercices: list, completion_for_users: dict) -> dict:
+    global LEADERBOARD_SNAPSHOT
+    if not is_leaderboard_snapshot_valid(selected_exercices, completion_for_users):
+        LEADERBOARD_SNAPSHOT = build_leaderboard_snapshot(selected_exercices, completion_for_users)
+    return LEADERBOARD_SNAPSHOT
+
+
+def is_leaderboard_snapshot_valid(selected_exercices: list, completion_for_users: dict) -> bool:
+    return (
+        LEADERBOARD_SNAPSHOT is not None
+        and LEADERBOARD_SNAPSHOT["version"] == db.STATE_VERSION
+        and LEADERBOARD_SNAPSHOT["selected_exercices"] == tuple(selected_exercices)
+        and LEADERBOARD_SNAPSHOT["completion_for_users"] is completion_for_users
+        and LEADERBOARD_SNAPSHOT["notification_earners"] == get_notification_earners()
+        and time.time() < LEADERBOARD_SNAPSHOT["expires_at"]
+    )
+
+
+def get_notification_earners() -> tuple:
+    return tuple(trophy.get_notification_earners() for trophy in ALL_TROPHIES if trophy.uses_notifications)
+
+
+def build_leaderboard_snapshot(selected_exercices: list, completion_for_users: dict) -> dict:
+    now = time.time()
+    snapshot = {
+        "version": db.STATE_VERSION,
+        "selected_exercices": tuple(selected_exercices),
+        "completion_for_users": completion_for_users,
+        "notification_earners": get_notification_earners(),
+        "expires_at": float("inf"),
+        "user_stats": compute_user_stats(selected_exercices, completion_for_users),
+        "on_fire_interval_by_user": {},
+        "trophies_by_user": defaultdict(list),
+        "status_by_user": {},
+    }
+    for entry in get_users_on_fire(selected_exercices, completion_for_users):
+        snapshot["on_fire_interval_by_user"][entry["user_id"]] = entry["time_on_fire_interval"]
+    for trophy in snapshot["user_stats"]["trophies"].values():
+        for user in trophy["users"]:
+            snapshot["trophies_by_user"][user["user_id"]].append(trophy["metadata"])
+
+    if len(snapshot["on_fire_interval_by_user"]) > 0:
+        next_fire_end = min(interval[1] for interval in snapshot["on_fire_interval_by_user"].values())
+        snapshot["expires_at"] = min(next_fire_end, now + leaderboard_settings["time_on_fire_refresh_sec"])
+
+    for user_id in completion_for_users.keys():
+        snapshot["status_by_user"][user_id] = build_user_status(user_id, snapshot)
+    return snapshot
+
 
+def build_user_status(user_id: int, snapshot: dict) -> dict:
+    user_stats = snapshot["user_stats"]
     status = {
-        "is_on_fire": user_id in [entry['user_id'] for entry in users_on_fire],
-        "on_fire_last_interval": next((entry['time_on_fire_interval'] for entry in users_on_fire if entry['user_id'] == user_id), None),
+        "is_on_fire": user_id in snapshot["on_fire_interval_by_user"],
+        "on_fire_last_interval": snapshot["on_fire_interval_by_user"].get(user_id, None),
         "is_on_fire_leaderboard": user_id in [entry['user_id'] for entry in user_stats["time_on_fire"]],
         "is_on_all_house_fame": user_id in [entry['user_id'] for entry in user_stats["hall_of_fame"]],
         "is_speed_runner": user_id in [entry['user_id'] for entry in user_stats["speed_runner"]],
-        "trophies": collected_trophies,
+        "trophies": snapshot["trophies_by_user"].get(user_id, []),
     }
     return status
 
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import os
+import sys
+import threading
+import time
+import traceback
+
+import backend.metrics as metrics
+from backend.appConfig import logger
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# A heartbeat task measures how late the event loop wakes up compared to the requested sleep. Stalls are measured by a
+# watchdog thread: every `threshold / 10` it posts a probe to the loop and, when a probe has not run after `threshold`,
+# records the stack of the loop thread so that the blocking callback can be identified. The duration of a stall is the
+# time the probe waited, which undercounts the block by at most the probe period.
+class LoopMonitor:
+
+    def __init__(self, interval: float = 0.05, threshold: float = 0.1, max_slow_callbacks: int = 100, lag_history_size: int = 1200):
+        self.interval = interval
+        self.threshold = threshold
+        self.probe_interval = threshold / 10
+        self.slow_callbacks = collections.deque([], max_slow_callbacks)
+        self.lag_history = collections.deque([], lag_history_size)
+        self.lock = threading.Lock()
+        self.loop = None
+        self.loop_thread_id = None
+        self.probe_sent_at = None
+        self.current_stall = None
+        self.watchdog = None
+        self.stats = {
+            'samples': 0,
+            'last': 0.0,
+            'max': 0.0,
+            'total': 0.0,
+            'over_threshold': 0,
+            'slow_callbacks': 0,
+        }
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = threading.get_ident()
+        if self.watchdog is None or not self.watchdog.is_alive():
+            self.watchdog = threading.Thread(target=self.watch, name='loop-monitor', daemon=True)
+            self.watchdog.start()
+        while True:
+            start_time = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.record_lag(max(0, time.monotonic() - start_time - self.interval))
+
+    def record_lag(self, lag: float):
+        self.stats['samples'] += 1
+        self.stats['last'] = lag
+        self.stats['max'] = max(self.stats['max'], lag)
+        self.stats['total'] += lag
+        if lag > self.threshold:
+            self.stats['over_threshold'] += 1
+        self.lag_history.append((time.time(), lag,))
+        metrics.LOOP_LAG.observe(lag)
+
+    # Runs on the loop once the callbacks queued before the probe are done
+    def answer_probe(self):
+        duration = time.monotonic() - self.probe_sent_at
+        with self.lock:
+            self.probe_sent_at = None
+            stall = self.current_stall
+            self.current_stall = None
+        if stall is None and duration >= self.threshold:
+            # Ended between two looks of the watchdog, the stack could not be captured
+            stall = {'detected_at': time.time(), 'location': 'unknown', 'stack': []}
+        if stall is not None:
+            stall['duration'] = duration
+            self.stats['slow_callbacks'] += 1
+            self.slow_callbacks.append(stall)
+            logger.warning(f"Event loop blocked for {stall['duration']:.3f}s in {stall['location']}")
+
+    def watch(self):
+        while True:
+            time.sleep(self.probe_interval)
+            with self.lock:
+                if self.loop is None or self.current_stall is not None:
+                    continue
+                now = time.monotonic()
+                if self.probe_sent_at is None:
+                    self.probe_sent_at = now
+                    try:
+                        self.loop.call_soon_threadsafe(self.answer_probe)
+                    except RuntimeError:  # Loop closed
+                        return
+                    continue
+                if now - self.probe_sent_at < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread_id, None)
+                if frame is None:
+                    continue
+                stack = traceback.extract_stack(frame)
+                del frame
+                self.current_stall = {
+                    'detected_at': time.time(),
+                    'duration': None,
+                    'location': get_location(stack),
+                    'stack': traceback.format_list(stack),
+                }
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats['avg'] = stats['total'] / max(1, stats['samples'])
+        stats['interval'] = self.interval
+        stats['threshold'] = self.threshold
+        stats['blocked'] = self.current_stall is not None
+        return stats
+
+    # Slow callbacks grouped by the location that was blocking the loop, slowest first
+    def get_slow_callback_summary(self) -> list:
+        locations = {}
+        for slow_callback in list(self.slow_callbacks):
+            summary = locations.setdefault(slow_callback['location'], {'location': slow_callback['location'], 'count': 0, 'total_duration': 0.0, 'max_duration': 0.0, 'last_seen': None})
+            summary['count'] += 1
+            summary['total_duration'] += slow_callback['duration']
+            summary['max_duration'] = max(summary['max_duration'], slow_callback['duration'])
+            summary['last_seen'] = slow_callback['detected_at']
+        return sorted(locations.values(), key=lambda x: x['total_duration'], reverse=True)
+
+    def get_slow_callbacks(self) -> list:
+        return [dict(slow_callback) for slow_callback in list(self.slow_callbacks)]
+
+    def export(self) -> dict:
+        return {
+            'exported_at': time.time(),
+            'stats': self.get_stats(),
+            'summary': self.get_slow_callback_summary(),
+            'slow_callbacks': self.get_slow_callbacks(),
+            'lag_history': list(self.lag_history),
+        }
+
+
+# Innermost frame of the application code, where the loop was blocked from
+def get_location(stack: traceback.StackSummary) -> str:
+    for frame in reversed(stack):
+        if frame.filename.startswith(BACKEND_DIR) and not frame.filename.endswith('loopmonitor.py'):
+            return f"{os.path.relpath(frame.filename, os.path.dirname(BACKEND_DIR))}:{frame.lineno} in {frame.name}"
+    if len(stack) > 0:
+        return f"{stack[-1].filename}:{stack[-1].lineno} in {stack[-1].name}"
+    return 'unknown'
@@ -22,6 +22,7 @@ def main():
     parser.add_argument('--exercise_folder', type=str, required=False, default=config.exercise_directory, help='The folder containing all exercises')
     parser.add_argument('--zmq_log_file', type=str, required=False, default=None, help='A ZMQ log file to replay. Will disable the ZMQ subscription defined in the settings.')
     parser.add_argument('--zmq_start_line_number', type=int, required=False, default=0, help='The line at which the ZMQ log file used for replay should start being fed.')
+    parser.add_argument('--zmq_replay_speed', type=float, required=False, default=None, help='Follow the original timing of the replayed ZMQ log file, scaled by this factor. 0 replays it as fast as possible. By default, a message is fed every 10ms. A line index of the file is cached in ~/.cache/skillaegis/replay.')
     parser.add_argument('--misp_url', type=str, required=False, help='The MISP URL to be used. Overrides what is defined in the config.py setting file.')
     parser.add_argument('--misp_apikey', type=str, required=False, help='MISP API KEY to be used. Overrides what is defined in the config.py setting file.')
     parser.add_argument('--misp_skipssl_state', type=str, choices=['1', '0', 'default'], default='default', required=False, help='MISP skip ssl value to be used. Overrides what is defined in the config.py setting file.')
@@ -53,7 +54,7 @@ def main():
     if args.debug:
         print("Starting server on DEBUG mode")
 
-    web.run_app(init_app(args.zmq_log_file, args.zmq_start_line_number, args.debug), host=args.host, port=args.port)
+    web.run_app(init_app(args.zmq_log_file, args.zmq_start_line_number, args.debug, args.zmq_replay_speed), host=args.host, port=args.port)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+
+import bisect
+import functools
+import math
+import time
+from typing import Union
+
+# Metrics kept in memory and exposed in the Prometheus text format on /metrics. Every metric has a fixed set of label
+# names and one series per combination of label values.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+REGISTRY = {}
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.series = {}
+        REGISTRY[name] = self
+
+    def get_key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(labelname, '')) for labelname in self.labelnames)
+
+    def format_labels(self, key: tuple, extra: Union[tuple, None] = None) -> str:
+        pairs = list(zip(self.labelnames, key))
+        if extra is not None:
+            pairs.append(extra)
+        if len(pairs) == 0:
+            return ''
+        return '{' + ','.join(f'{name}="{escape_label_value(value)}"' for name, value in pairs) + '}'
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for key, value in self.series.items():
+            lines.append(f"{self.name}{self.format_labels(key)} {format_value(value)}")
+        return lines
+
+    def get_summary(self) -> dict:
+        return {'-'.join(key) if len(key) > 0 else 'total': value for key, value in self.series.items()}
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.get_key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        self.series[self.get_key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.get_key(labels)
+        self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self.get_key(labels)
+        series = self.series.get(key, None)
+        if series is None:
+            series = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0, 'count': 0, 'max': 0.0}
+            self.series[key] = series
+        series['counts'][bisect.bisect_left(self.buckets, value)] += 1
+        series['sum'] += value
+        series['count'] += 1
+        series['max'] = max(series['max'], value)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{self.format_labels(key, ('le', format_value(bound)))} {cumulative}")
+            lines.append(f"{self.name}_bucket{self.format_labels(key, ('le', '+Inf'))} {series['count']}")
+            lines.append(f"{self.name}_sum{self.format_labels(key)} {format_value(series['sum'])}")
+            lines.append(f"{self.name}_count{self.format_labels(key)} {series['count']}")
+        return lines
+
+    # Upper bound of the bucket containing the quantile
+    def get_quantile(self, series: dict, quantile: float) -> float:
+        rank = quantile * series['count']
+        cumulative = 0
+        for bound, count in zip(self.buckets, series['counts']):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, series['max'])
+        return series['max']
+
+    def get_summary(self) -> dict:
+        summary = {}
+        for key, series in self.series.items():
+            summary['-'.join(key) if len(key) > 0 else 'total'] = {
+                'count': series['count'],
+                'avg': series['sum'] / max(1, series['count']),
+                'p50': self.get_quantile(series, 0.5),
+                'p99': self.get_quantile(series, 0.99),
+                'max': series['max'],
+            }
+        return summary
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def render_prometheus() -> str:
+    lines = []
+    for metric in REGISTRY.values():
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
+
+
+def get_summary() -> dict:
+    return {name: metric.get_summary() for name, metric in REGISTRY.items()}
+
+
+# Observes the duration of the decorated coroutine in `histogram`
+def timed(histogram: Histogram, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start_time, **labels)
+        return wrapper
+    return decorator
+
+
+ZMQ_MESSAGES = Counter('skillaegis_zmq_messages_total', 'ZMQ messages received', ('topic',))
+ZMQ_BYTES = Counter('skillaegis_zmq_received_bytes_total', 'Size of the ZMQ messages received', ('topic',))
+HANDLER_DURATION = Histogram('skillaegis_handler_duration_seconds', 'Time spent handling a ZMQ message or a webhook', ('handler',))
+INJECT_CHECK_DURATION = Histogram('skillaegis_inject_check_duration_seconds', 'Time spent evaluating one inject evaluation', ('strategy', 'target_tool',))
+MISP_REQUESTS = Counter('skillaegis_misp_requests_total', 'Requests performed on MISP', ('endpoint', 'status',))
+MISP_REQUEST_DURATION = Histogram('skillaegis_misp_request_duration_seconds', 'Duration of the requests performed on MISP', ('method', 'endpoint',))
+SANDBOX_DURATION = Histogram('skillaegis_sandbox_request_duration_seconds', 'Duration of the requests performed on the sandbox agent', ('path', 'status',))
+EMIT_SIZE = Histogram('skillaegis_socketio_emit_bytes', 'Size of the encoded Socket.IO packets sent to clients', ('event',), buckets=SIZE_BUCKETS)
+CONNECTED_CLIENTS = Gauge('skillaegis_connected_clients', 'Socket.IO clients currently connected')
+LOOP_LAG = Histogram('skillaegis_event_loop_lag_seconds', 'Delay of the event loop waking up compared to the requested sleep')
@@ -1,28 +1,104 @@
 #!/usr/bin/env python3
 
+import collections
+import contextlib
+import contextvars
+import copy
 import json
-from datetime import timedelta
+import re
+import time
 from typing import Union
 from urllib.parse import urljoin
 import asyncio
-import requests # type: ignore
-import requests.adapters # type: ignore
-from requests_cache import CachedSession
-from requests.packages.urllib3.exceptions import InsecureRequestWarning # type: ignore
-requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
+import aiohttp
 
 import backend.config as config
+import backend.metrics as metrics
+import backend.profiler as profiler
 from backend.appConfig import logger, misp_settings
 
 BASE_TIMEOUT = 10
+POOL_SIZE = 50
+KEEPALIVE_TIMEOUT = 30
+CACHE_EXPIRE_AFTER = 5
+CACHE_MAX_ENTRIES = 1024
+# IDs and UUIDs in paths are replaced so that requests on different objects are counted under the same endpoint
+ENDPOINT_ID_REGEX = re.compile(r'/(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12})(?=/|$)')
 
-requestSession = CachedSession(cache_name='misp_cache', expire_after=timedelta(seconds=5))
-adapterCache = requests.adapters.HTTPAdapter(pool_connections=50, pool_maxsize=50)
-requestSession.mount('https://', adapterCache)
-requestSession.mount('http://', adapterCache)
+requestSession = None
+
+
+# Default in-memory cache for GET responses. Any object with the same async `get`/`set` can be plugged with `set_response_cache()`
+# Values are stored serialized so that every hit gets its own copy
+class MemoryResponseCache:
+
+    def __init__(self, expire_after: float = CACHE_EXPIRE_AFTER, max_entries: int = CACHE_MAX_ENTRIES):
+        self.expire_after = expire_after
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+
+    async def get(self, key: tuple):
+        entry = self.entries.get(key, None)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if time.time() >= expires_at:
+            del self.entries[key]
+            return None
+        return json.loads(value)
+
+    async def set(self, key: tuple, value):
+        self.entries[key] = (time.time() + self.expire_after, json.dumps(value),)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+responseCache = MemoryResponseCache()
+
+
+def set_response_cache(cache):
+    global responseCache
+    responseCache = cache
+
+
+def get_session() -> aiohttp.ClientSession:
+    global requestSession
+    if requestSession is None or requestSession.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, limit_per_host=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        requestSession = aiohttp.ClientSession(connector=connector)
+    return requestSession
+
+
+async def close_session():
+    global requestSession
+    if requestSession is not None and not requestSession.closed:
+        await requestSession.close()
+    requestSession = None
+
+
+# Read queries being performed, shared by all callers asking for the same query in the meantime
+IN_FLIGHT_QUERIES = {}
+# Queries performed while handling the current message. See `fetch_scope()`
+FETCH_SCOPE = contextvars.ContextVar('misp_fetch_scope', default=None)
+FETCH_STATS = {
+    'queries': 0,
+    'coalesced': 0,
+    'scope_hits': 0,
+}
 
 
 async def get(url, data={}, api_key=None):
+    with profiler.phase('fetch'):
+        return await request('GET', url, data if data else None, api_key=api_key, use_cache=True)
+
+
+async def post(url, data={}, api_key=None):
+    with profiler.phase('fetch'):
+        return await request('POST', url, json.dumps(data), api_key=api_key)
+
+
+async def request(method: str, url: str, data=None, api_key=None, use_cache: bool = False):
     api_key = api_key if api_key is not None else config.misp_apikey
     headers = {
         'User-Agent': 'SkillAegis',
@@ -31,68 +107,108 @@ async def get(url, data={}, api_key=None):
         "Content-Type": "application/json"
     }
     full_url = urljoin(config.misp_url, url)
+    cache_key = (method, full_url, api_key, json.dumps(data, sort_keys=True, default=str),)
+    if use_cache:
+        cached = await responseCache.get(cache_key)
+        if cached is not None:
+            return cached
+
+    endpoint = get_endpoint_label(url)
+    status = 'error'
+    start_time = time.perf_counter()
     try:
-        loop = asyncio.get_event_loop()
-        job = lambda: requestSession.get(
+        async with get_session().request(
+            method,
             full_url,
             data=data,
             headers=headers,
-            verify=not config.misp_skipssl,
-            timeout=BASE_TIMEOUT,
-        )
-        runningJob = loop.run_in_executor(None, job)
-        response = await runningJob
-    except requests.exceptions.ConnectionError as e:
+            ssl=not config.misp_skipssl,
+            timeout=aiohttp.ClientTimeout(total=BASE_TIMEOUT),
+        ) as response:
+            content = await response.text()
+            status = response.status
+            content_type = response.headers.get('content-type', '')
+    except aiohttp.ClientConnectionError as e:
         logger.info('Could not perform request on MISP. %s', e)
         return None
-    except requests.exceptions.Timeout as e:
+    except asyncio.TimeoutError as e:
+        status = 'timeout'
         error_message = f"Timeout after {BASE_TIMEOUT}sec"
         logger.info(error_message)
         return error_message
     except Exception as e:
         logger.warning('Could not perform request on MISP. %s', e)
         return None
+    finally:
+        metrics.MISP_REQUEST_DURATION.observe(time.perf_counter() - start_time, method=method, endpoint=endpoint)
+        metrics.MISP_REQUESTS.inc(endpoint=endpoint, status=status)
+
+    result = content
+    if content_type.startswith('application/json'):
+        try:
+            result = json.loads(content)
+        except json.JSONDecodeError:
+            pass
+    if use_cache and status == 200:
+        await responseCache.set(cache_key, result)
+    return result
+
+
+def get_endpoint_label(url: str) -> str:
+    path = url.split('?', 1)[0]
+    if '://' in path:
+        path = path.split('://', 1)[1].partition('/')[2]
+    path = '/' + path.strip('/')
+    return ENDPOINT_ID_REGEX.sub('/:id', path)
+
+
+# All queries performed in this scope for the same url, authkey and payload share the same result
+@contextlib.contextmanager
+def fetch_scope():
+    token = FETCH_SCOPE.set({})
     try:
-        return response.json() if response.headers['content-type'].startswith('application/json') else response.text
-    except requests.exceptions.JSONDecodeError:
-        return response.text
+        yield
+    finally:
+        FETCH_SCOPE.reset(token)
 
 
-async def post(url, data={}, api_key=None):
+# Only use for queries without side effects as their result is shared between callers. Each caller gets its own copy
+async def coalesced_query(request_method: str, url: str, payload: dict = {}, api_key=None):
     api_key = api_key if api_key is not None else config.misp_apikey
-    headers = {
-        'User-Agent': 'SkillAegis',
-        "Authorization": api_key,
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
-    full_url = urljoin(config.misp_url, url)
-    try:
-        loop = asyncio.get_event_loop()
-        job = lambda: requestSession.post(full_url, data=json.dumps(data), headers=headers, verify=not config.misp_skipssl)
-        runningJob = loop.run_in_executor(None, job)
-        response = await runningJob
-    except requests.exceptions.ConnectionError as e:
-        logger.info('Could not perform request on MISP. %s', e)
-        return None
-    except Exception as e:
-        logger.warning('Could not perform request on MISP. %s', e)
-        return None
-    try:
-        return response.json() if response.headers['content-type'].startswith('application/json') else response.text
-    except requests.exceptions.JSONDecodeError:
-        return response.text
+    key = (request_method, url, api_key, json.dumps(payload, sort_keys=True, default=str),)
+    FETCH_STATS['queries'] += 1
+
+    with profiler.phase('fetch'):  # The spawned query inherits the phase and is not counted twice
+        scope = FETCH_SCOPE.get()
+        if scope is not None and key in scope:
+            FETCH_STATS['scope_hits'] += 1
+            return copy.deepcopy(await asyncio.shield(scope[key]))
+
+        query = IN_FLIGHT_QUERIES.get(key, None)
+        if query is None:
+            if request_method == 'POST':
+                query = asyncio.ensure_future(post(url, payload, api_key=api_key))
+            else:
+                query = asyncio.ensure_future(get(url, payload, api_key=api_key))
+            IN_FLIGHT_QUERIES[key] = query
+            query.add_done_callback(lambda _: IN_FLIGHT_QUERIES.pop(key, None))
+        else:
+            FETCH_STATS['coalesced'] += 1
+        if scope is not None:
+            scope[key] = query
+        return copy.deepcopy(await asyncio.shield(query))
+
+
+def get_fetch_stats() -> dict:
+    return dict(FETCH_STATS)
 
 
 async def getEvent(event_id: int) -> Union[None, dict]:
-    return await get(f'/events/view/{event_id}')
+    return await coalesced_query('GET', f'/events/view/{event_id}')
 
 
 async def doRestQuery(authkey: str, request_method: str, url: str, payload: dict = {}) -> Union[None, dict]:
-    if request_method == 'POST':
-        return await post(url, payload, api_key=authkey)
-    else:
-        return await get(url, payload, api_key=authkey)
+    return await coalesced_query('POST' if request_method == 'POST' else 'GET', url, payload, api_key=authkey)
 
 
 async def getVersion() -> Union[None, dict]:
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import contextvars
+import http.cookiejar
+import json
+import time
+import urllib.request
+from typing import Union
+
+import backend.db as db
+
+# Cost of the inject evaluations, aggregated per inject and evaluation strategy. The time of an evaluation is split
+# into the phases below, the remainder (routing, context checks, ...) is reported as `other`.
+# Phases do not nest: a phase started within another one is counted in the outer phase.
+
+PHASES = ('fetch', 'jq', 'condition', 'sandbox',)
+
+PROFILE = contextvars.ContextVar('inject_profile', default=None)
+ACTIVE_PHASE = contextvars.ContextVar('inject_profile_phase', default=None)
+INJECT_PROFILES = {}
+
+
+class phase:
+    __slots__ = ('name', 'profile', 'token', 'start_time')
+
+    def __init__(self, name: str):
+        self.name = name
+        self.token = None
+
+    def __enter__(self):
+        self.profile = PROFILE.get()
+        if self.profile is not None and ACTIVE_PHASE.get() is None:
+            self.token = ACTIVE_PHASE.set(self.name)
+            self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.token is not None:
+            self.profile['phases'][self.name] += time.perf_counter() - self.start_time
+            ACTIVE_PHASE.reset(self.token)
+            self.token = None
+        return False
+
+
+@contextlib.contextmanager
+def profile_evaluation(inject_uuid: str, strategy: Union[str, None], timed: bool = False):
+    profile = {'phases': {phase_name: 0.0 for phase_name in PHASES}, 'outcome': None}
+    token = PROFILE.set(profile)
+    phase_token = ACTIVE_PHASE.set(None)
+    start_time = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        duration = time.perf_counter() - start_time
+        ACTIVE_PHASE.reset(phase_token)
+        PROFILE.reset(token)
+        record_profile(inject_uuid, strategy, timed, duration, profile)
+
+
+def record_profile(inject_uuid: str, strategy: Union[str, None], timed: bool, duration: float, profile: dict):
+    key = (inject_uuid, strategy or 'unknown',)
+    entry = INJECT_PROFILES.get(key, None)
+    if entry is None:
+        entry = {
+            'runs': 0,
+            'timed_runs': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'cancelled': 0,
+            'errors': 0,
+            'total': 0.0,
+            'max': 0.0,
+            'phases': {phase_name: 0.0 for phase_name in PHASES},
+        }
+        INJECT_PROFILES[key] = entry
+    entry['runs'] += 1
+    entry['timed_runs'] += 1 if timed else 0
+    if profile['outcome'] == 'cancelled':
+        entry['cancelled'] += 1
+    elif profile['outcome'] == 'error' or profile['outcome'] is None:
+        entry['errors'] += 1
+    elif profile['outcome']:
+        entry['succeeded'] += 1
+    else:
+        entry['failed'] += 1
+    entry['total'] += duration
+    entry['max'] = max(entry['max'], duration)
+    for phase_name, phase_duration in profile['phases'].items():
+        entry['phases'][phase_name] += phase_duration
+
+
+def reset_profiles():
+    INJECT_PROFILES.clear()
+
+
+# Injects sorted by their total evaluation time, the most expensive first
+def get_report(limit: Union[int, None] = None) -> dict:
+    grand_total = sum(entry['total'] for entry in INJECT_PROFILES.values())
+    injects = []
+    for (inject_uuid, strategy), entry in INJECT_PROFILES.items():
+        inject = db.INJECT_BY_UUID.get(inject_uuid, {})
+        phases = dict(entry['phases'])
+        phases['other'] = max(0, entry['total'] - sum(entry['phases'].values()))
+        injects.append({
+            'inject_uuid': inject_uuid,
+            'inject_name': inject.get('name', None),
+            'exercise_uuid': inject.get('exercise_uuid', None),
+            'target_tool': inject.get('target_tool', None),
+            'strategy': strategy,
+            'runs': entry['runs'],
+            'timed_runs': entry['timed_runs'],
+            'succeeded': entry['succeeded'],
+            'failed': entry['failed'],
+            'cancelled': entry['cancelled'],
+            'errors': entry['errors'],
+            'total': entry['total'],
+            'avg': entry['total'] / max(1, entry['runs']),
+            'max': entry['max'],
+            'share': entry['total'] / grand_total if grand_total > 0 else 0,
+            'phases': phases,
+        })
+    injects = sorted(injects, key=lambda x: x['total'], reverse=True)
+    return {
+        'generated_at': time.time(),
+        'total': grand_total,
+        'injects': injects[:limit] if limit is not None else injects,
+    }
+
+
+def print_report(report: dict):
+    print(f"Total evaluation time: {report['total']:.3f}s")
+    header = f"{'share':>6} {'total':>9} {'avg':>9} {'runs':>6}  " + ' '.join(f"{phase_name:>9}" for phase_name in PHASES + ('other',)) + "  inject"
+    print(header)
+    for entry in report['injects']:
+        phases = ' '.join(f"{entry['phases'][phase_name]:>8.3f}s" for phase_name in PHASES + ('other',))
+        name = entry['inject_name'] or entry['inject_uuid']
+        print(f"{100 * entry['share']:>5.1f}% {entry['total']:>8.3f}s {1000 * entry['avg']:>7.1f}ms {entry['runs']:>6}  {phases}  {name} [{entry['strategy']}]")
+
+
+def fetch_report(url: str, username: str, password: str, limit: Union[int, None]) -> dict:
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+    login_request = urllib.request.Request(
+        f"{url.rstrip('/')}/login",
+        data=json.dumps({'username': username, 'password': password}).encode('utf-8'),
+        headers={'Content-Type': 'application/json'},
+    )
+    opener.open(login_request).read()
+    report_url = f"{url.rstrip('/')}/inject_profiles" + (f"?limit={limit}" if limit is not None else '')
+    with opener.open(report_url) as response:
+        return json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the injects that dominate the evaluation cost of a running dashboard.')
+    parser.add_argument('--url', type=str, default='http://localhost:4000', help='URL of the dashboard')
+    parser.add_argument('--username', type=str, required=False, help='Admin username')
+    parser.add_argument('--password', type=str, required=False, help='Admin password')
+    parser.add_argument('--file', type=str, default=None, help='Read the report from a JSON file instead of the dashboard')
+    parser.add_argument('--limit', type=int, default=20, help='Number of injects to show')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file) as f:
+            report = json.load(f)
+        report = report.get('inject_profiles', report)  # Benchmark reports embed the profiles
+        report['injects'] = report['injects'][:args.limit]
+    else:
+        if args.username is None or args.password is None:
+            parser.error('--username and --password are required to fetch the report from the dashboard')
+        report = fetch_report(args.url, args.username, args.password, args.limit)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
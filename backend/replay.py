@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Callable, Union
+
+from backend.appConfig import logger
+
+LINE_INDEX_STEP = 1000  # A byte offset is kept every LINE_INDEX_STEP lines
+LINE_INDEX_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'skillaegis', 'replay')
+FIXED_INTERVAL = 0.01  # Delay between two messages when the original timing is not followed
+YIELD_EVERY = 100  # At max speed, give the event loop a chance to run other tasks every YIELD_EVERY lines
+CREATED_REGEX = re.compile(rb'"created":\s*"([^"]+)"')
+
+
+# Offsets of every LINE_INDEX_STEP-th line of the file, saved in LINE_INDEX_DIR so that it is built once per log file
+def get_line_index(filename: str) -> dict:
+    stat = os.stat(filename)
+    index_filename = os.path.join(LINE_INDEX_DIR, f"{hashlib.sha256(os.path.abspath(filename).encode('utf-8')).hexdigest()}.json")
+    try:
+        with open(index_filename) as f:
+            index = json.load(f)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime and index['step'] == LINE_INDEX_STEP:
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+
+    offsets = []
+    line_count = 0
+    offset = 0
+    with open(filename, 'rb') as f:
+        for line in f:
+            if line_count % LINE_INDEX_STEP == 0:
+                offsets.append(offset)
+            offset += len(line)
+            line_count += 1
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'step': LINE_INDEX_STEP, 'lines': line_count, 'offsets': offsets}
+    try:
+        os.makedirs(LINE_INDEX_DIR, exist_ok=True)
+        with open(index_filename, 'w') as f:
+            json.dump(index, f)
+    except OSError:
+        logger.warning(f"Could not save the line index of {filename}")
+    return index
+
+
+# Returns the epoch of the `created` field of the message, if any
+def get_message_time(raw: bytes) -> Union[float, None]:
+    match = CREATED_REGEX.search(raw)
+    if match is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(match.group(1).decode('utf-8')).timestamp()
+    except ValueError:
+        return None
+
+
+# Feeds the messages of a ZMQ log file (`topic message` per line) to `handler(topic, raw)`.
+# By default messages are fed every FIXED_INTERVAL. `speed` is a factor applied to the original timing of the messages
+# instead, 0 replays them as fast as possible.
+# `get_handler_errors` returns the errors counted where the messages are eventually handled, e.g. in the ingest pipeline.
+class ReplayEngine:
+
+    def __init__(self, filename: str, handler: Callable, speed: Union[float, None] = None, start_line: int = 0, get_handler_errors: Union[Callable, None] = None):
+        self.filename = filename
+        self.handler = handler
+        self.speed = speed
+        self.start_line = start_line
+        self.get_handler_errors = get_handler_errors
+        self.handler_errors_at_start = 0
+        self.total_lines = 0
+        self.stats = {
+            'lines': 0,
+            'bytes': 0,
+            'ingest_errors': 0,
+            'started_at': None,
+            'finished_at': None,
+            'behind_schedule': 0.0,
+        }
+
+    async def run(self):
+        index = await asyncio.to_thread(get_line_index, self.filename)  # Scanning a large file would block the loop
+        self.total_lines = index['lines']
+        checkpoint = min(self.start_line // LINE_INDEX_STEP, len(index['offsets']) - 1) if len(index['offsets']) > 0 else 0
+        line_number = checkpoint * LINE_INDEX_STEP
+        print(f'Preparing to feed {self.total_lines} lines..')
+        print(f'Starting from line {self.start_line}.')
+
+        self.stats['started_at'] = time.time()
+        self.handler_errors_at_start = self.get_handler_errors() if self.get_handler_errors is not None else 0
+        last_print = time.time()
+        first_message_time = None
+        with open(self.filename, 'rb') as f:
+            if len(index['offsets']) > 0:
+                f.seek(index['offsets'][checkpoint])
+            for line in f:
+                line_number += 1
+                if line_number - 1 < self.start_line:
+                    continue
+                topic, _, raw = line.rstrip(b'\n').partition(b' ')
+
+                if self.speed is None:
+                    if topic != b'misp_json_self':
+                        await asyncio.sleep(FIXED_INTERVAL)
+                elif self.speed > 0:
+                    message_time = get_message_time(raw)
+                    if message_time is not None:
+                        if first_message_time is None:
+                            first_message_time = message_time
+                        delay = (message_time - first_message_time) / self.speed - (time.time() - self.stats['started_at'])
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                        else:
+                            self.stats['behind_schedule'] = -delay
+                elif self.stats['lines'] % YIELD_EVERY == 0:
+                    await asyncio.sleep(0)
+
+                try:
+                    await self.handler(topic.decode('utf-8', 'replace'), raw)
+                except Exception as e:
+                    self.stats['ingest_errors'] += 1
+                    logger.error('Error handling replayed message at line %s: %s', line_number, e)
+                self.stats['lines'] += 1
+                self.stats['bytes'] += len(line)
+
+                now = time.time()
+                if now - last_print >= 5:
+                    last_print = now
+                    print(f'Feeding {line_number} / {self.total_lines} - ({100 * line_number / max(1, self.total_lines):.1f}%) - {self.get_stats()["lines_per_sec"]:.0f} lines/s')
+        self.stats['finished_at'] = time.time()
+        print(f'Feeding done. {self.stats["lines"]} lines in {self.get_stats()["elapsed"]:.1f}s')
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        if stats['started_at'] is None:
+            stats['elapsed'] = 0
+        else:
+            stats['elapsed'] = (stats['finished_at'] or time.time()) - stats['started_at']
+        elapsed = max(stats['elapsed'], 1e-6)
+        stats['lines_per_sec'] = stats['lines'] / elapsed
+        stats['bytes_per_sec'] = stats['bytes'] / elapsed
+        stats['total_lines'] = self.total_lines
+        stats['speed'] = self.speed
+        stats['handler_errors'] = self.get_handler_errors() - self.handler_errors_at_start if self.get_handler_errors is not None else 0
+        stats['errors'] = stats['ingest_errors'] + stats['handler_errors']
+        return stats
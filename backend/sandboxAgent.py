@@ -4,59 +4,231 @@ import epicbox
 
 PYTHON_DOCKER_IMAGE = "python:3.13-alpine"
 
-from http.server import BaseHTTPRequestHandler, HTTPServer
+import argparse
+import collections
+import contextlib
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import json
+import queue
+import threading
+import time
 
 
-sandbox = None
 epicbox.configure(profiles=[epicbox.Profile("python", PYTHON_DOCKER_IMAGE)])
 sandbox_limits = {"cputime": 1, "memory": 64}
 
+POOL_SIZE = 4
+MAX_SCRIPTS = 256
+MAX_QUEUE_DEPTH = 64  # Requests waiting for a sandbox above this are rejected
+QUEUE_TIMEOUT = 10  # Below the client's EVALUATION_TIMEOUT, so that requests it gave up on are not run anymore
+
+# Runs the registered script on the data and context received on stdin. Anything printed by the script is
+# captured so that the only output is the structured result
+HARNESS_SCRIPT = """
+import contextlib
+import io
+import json
+import sys
+import traceback
+
+result = {"outcome": None, "stdout": "", "error": None}
+output = io.StringIO()
+try:
+    payload = json.load(sys.stdin)
+    namespace = {}
+    script_path = f"script_{payload['script_hash']}.py"
+    with open(script_path) as f:
+        exec(compile(f.read(), script_path, "exec"), namespace)
+    with contextlib.redirect_stdout(output):
+        result["outcome"] = namespace["evaluate"](payload["input"]["data"], payload["input"]["context"]) is True
+except Exception:
+    result["outcome"] = None
+    result["error"] = traceback.format_exc()
+result["stdout"] = output.getvalue()
+sys.stdout.write(json.dumps(result))
+"""
+
+# Pre-warmed sandboxes, each one runs a single script at a time
+sandboxPool = queue.Queue()
+statsLock = threading.Lock()
+# Registered evaluation scripts by hash, and the hashes already written in each sandbox (least recently used first)
+scripts = collections.OrderedDict()
+scriptsLock = threading.Lock()
+writtenScripts = collections.defaultdict(collections.OrderedDict)
+AGENT_STATS = {
+    'pool_size': 0,
+    'busy': 0,
+    'queued': 0,
+    'max_queued': 0,
+    'executions': 0,
+    'rejected': 0,
+    'scripts_registered': 0,
+    'total_wait': 0.0,
+    'total_duration': 0.0,
+}
+
 
 class SimpleJSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep the client's connection open between evaluations
+
+    def do_GET(self):
+        if self.path != "/stats":
+            self.sendJSON(404, {"error": "Not found"})
+            return
+        self.sendJSON(200, getStats())
+
     def do_POST(self):
         content_length = int(self.headers.get("Content-Length", 0))
         body = self.rfile.read(content_length)
+        path, _, query = self.path.partition("?")
+
+        if path == "/scripts":
+            try:
+                script = json.loads(body)['script']
+            except (json.JSONDecodeError, KeyError, TypeError):
+                self.sendJSON(400, {"error": "Invalid JSON"})
+                return
+            self.sendJSON(200, {"script_hash": registerScript(script)})
+
+        elif path == "/evaluate":
+            script_hash = query.partition("script=")[2]
+            with scriptsLock:
+                script = scripts.get(script_hash, None)
+            if script is None:
+                self.sendJSON(404, {"error": "Unknown script"})
+                return
+            try:
+                result = doSandboxedExecution(script_hash, script, body)
+            except Exception as e:
+                self.sendJSON(500, {"error": f"Sandbox execution failed: {e}"})
+                return
+            if result is None:
+                self.sendJSON(503, {"error": "No sandbox available"})
+                return
+            self.sendJSON(200, parseResult(result))
+
+        else:
+            self.sendJSON(404, {"error": "Not found"})
+
+    def sendJSON(self, status: int, payload: dict):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
 
-        try:
-            data = json.loads(body)
-            script = data['script']
-            result = doSandboxedExecution(script)
-            response = {
-                "status": "success" if result["exit_code"] == 0 else "failure",
-                "exit_code": result["exit_code"],
-                "stdout": result["stdout"].decode("utf-8"),
-                "stderr": result["stderr"].decode("utf-8"),
-                "duration": result["duration"],
-            }
-
-            self.send_response(200)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps(response).encode("utf-8"))
-
-        except json.JSONDecodeError:
-            self.send_response(400)
-            self.send_header("Content-Type", "application/json")
-            self.end_headers()
-            self.wfile.write(json.dumps({"error": "Invalid JSON"}).encode("utf-8"))
-
-
-def doSandboxedExecution(script):
-    global sandbox
-    files = [{"name": "main.py", "content": script.encode("utf-8")}]
-    epicbox.sandboxes._write_files(sandbox.container, files)
-    result = epicbox.start(sandbox)
+
+def registerScript(script: str) -> str:
+    script_hash = hashlib.sha256(script.encode("utf-8")).hexdigest()
+    with scriptsLock:
+        if script_hash not in scripts:
+            AGENT_STATS['scripts_registered'] += 1
+        scripts[script_hash] = script
+        scripts.move_to_end(script_hash)
+        while len(scripts) > MAX_SCRIPTS:
+            scripts.popitem(last=False)
+    return script_hash
+
+
+def parseResult(result: dict) -> dict:
+    stdout = result["stdout"].decode("utf-8")
+    response = {
+        "status": "failure",
+        "outcome": None,
+        "exit_code": result["exit_code"],
+        "stdout": stdout,
+        "stderr": result["stderr"].decode("utf-8"),
+        "duration": result["duration"],
+    }
+    if result["exit_code"] != 0:  # Killed because of the limits, the harness could not report
+        return response
+    try:
+        harness_result = json.loads(stdout)
+    except json.JSONDecodeError:
+        return response
+    response["stdout"] = harness_result["stdout"]
+    if harness_result["error"] is not None:
+        response["stderr"] = harness_result["error"]
+    else:
+        response["status"] = "success"
+        response["outcome"] = harness_result["outcome"]
+    return response
+
+
+# The data is streamed on stdin, the script is only written in a sandbox the first time it runs there
+def doSandboxedExecution(script_hash: str, script: str, body: bytes):
+    with statsLock:
+        if AGENT_STATS['queued'] >= MAX_QUEUE_DEPTH:
+            AGENT_STATS['rejected'] += 1
+            return None
+        AGENT_STATS['queued'] += 1
+        AGENT_STATS['max_queued'] = max(AGENT_STATS['max_queued'], AGENT_STATS['queued'])
+
+    queued_at = time.time()
+    try:
+        sandbox = sandboxPool.get(timeout=QUEUE_TIMEOUT)
+    except queue.Empty:
+        sandbox = None
+    wait = time.time() - queued_at
+    with statsLock:
+        AGENT_STATS['queued'] -= 1
+        if sandbox is None:
+            AGENT_STATS['rejected'] += 1
+            return None
+        AGENT_STATS['busy'] += 1
+        AGENT_STATS['total_wait'] += wait
+
+    start_time = time.time()
+    try:
+        written = writtenScripts[id(sandbox)]  # Only used by the thread holding the sandbox
+        if script_hash not in written:
+            files = [{"name": f"script_{script_hash}.py", "content": script.encode("utf-8")}]
+            epicbox.sandboxes._write_files(sandbox.container, files)
+        written[script_hash] = True
+        written.move_to_end(script_hash)
+        while len(written) > MAX_SCRIPTS:
+            written.popitem(last=False)  # Forgotten scripts are written again when they run next
+        stdin = b'{"script_hash": "' + script_hash.encode("utf-8") + b'", "input": ' + body + b'}'
+        result = epicbox.start(sandbox, stdin=stdin)
+    finally:
+        sandboxPool.put(sandbox)
+        with statsLock:
+            AGENT_STATS['busy'] -= 1
+            AGENT_STATS['executions'] += 1
+            AGENT_STATS['total_duration'] += time.time() - start_time
     return result
 
+
+def getStats() -> dict:
+    with statsLock:
+        stats = dict(AGENT_STATS)
+    executions = max(1, stats['executions'])
+    stats['avg_wait'] = stats['total_wait'] / executions
+    stats['avg_duration'] = stats['total_duration'] / executions
+    return stats
+
+
 def startAgent():
     port = 9573
     server_address = ("", port)
-    httpd = HTTPServer(server_address, SimpleJSONHandler)
+    httpd = ThreadingHTTPServer(server_address, SimpleJSONHandler)
     httpd.serve_forever()
 
 
 if __name__ == '__main__':
-    with epicbox.create('python', command="python3 main.py", limits=sandbox_limits) as agentSandbox:
-        sandbox = agentSandbox
+    parser = argparse.ArgumentParser(description='Sandbox agent running python evaluations')
+    parser.add_argument('--pool_size', type=int, required=False, default=POOL_SIZE, help='Number of pre-warmed sandboxes')
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        for i in range(args.pool_size):
+            sandbox = stack.enter_context(epicbox.create('python', command="python3 main.py", limits=sandbox_limits))
+            epicbox.sandboxes._write_files(sandbox.container, [{"name": "main.py", "content": HARNESS_SCRIPT.encode("utf-8")}])
+            sandboxPool.put(sandbox)
+        AGENT_STATS['pool_size'] = args.pool_size
         startAgent()
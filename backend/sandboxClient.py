@@ -1,66 +1,229 @@
 #!/usr/bin/env python3
 
 
+import asyncio
+import collections
+import hashlib
 import json
-import http.client
+import re
+import time
 from typing import Union
+import aiohttp
+
+import backend.metrics as metrics
 
 headers = {"Content-Type": "application/json"}
 port = 9573
+agent_url = f"http://localhost:{port}"
 
-VALIDATION_TRUE = "__validation_true__"
-VALIDATION_FALSE = "__validation_false__"
 PYTHON_INDENT = ' '*4
 
+# Should match the size of the agent's sandbox pool, requests above it would only wait in the agent's queue
+POOL_SIZE = 4
+KEEPALIVE_TIMEOUT = 30
+# Covers the wait for a free sandbox in the agent and the execution itself. Keep it above the agent's QUEUE_TIMEOUT
+EVALUATION_TIMEOUT = 15
+RESULT_CACHE_EXPIRE_AFTER = 30
+RESULT_CACHE_MAX_ENTRIES = 1024
+CONTEXT_KEY_REGEX = re.compile(r"""\bcontext(?:\[\s*['"](\w+)['"]\s*\]|\.get\(\s*['"](\w+)['"])""")
+CONTEXT_USE_REGEX = re.compile(r"\bcontext\b")
+
+agentSession = None
+KNOWN_SCRIPTS = set()  # Hashes of the scripts already registered in the agent
+# digest -> (expires_at, result) of successful evaluations
+RESULT_CACHE = collections.OrderedDict()
+RESULT_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+    'expired': 0,
+    'evictions': 0,
+}
+CONTEXT_FIELDS_BY_SCRIPT = {}
+SANDBOX_STATS = {
+    'calls': 0,
+    'in_flight': 0,
+    'timeouts': 0,
+    'cancelled': 0,
+    'errors': 0,
+    'total_duration': 0.0,
+    'max_duration': 0.0,
+}
+
+
+def get_session() -> aiohttp.ClientSession:
+    global agentSession
+    if agentSession is None or agentSession.closed:
+        connector = aiohttp.TCPConnector(limit=POOL_SIZE, keepalive_timeout=KEEPALIVE_TIMEOUT)
+        agentSession = aiohttp.ClientSession(base_url=agent_url, connector=connector)
+    return agentSession
+
+
+async def close_session():
+    global agentSession
+    if agentSession is not None and not agentSession.closed:
+        await agentSession.close()
+    agentSession = None
+
+
+async def run(inject_evaluation: dict, data: dict, context: dict, debug: bool = False) -> Union[bool, tuple]:
+    script = build_script(inject_evaluation)
+    result = await evaluateInAgent(script, data, context)
+    eval_returned_true = result['status'] == 'success' and result.get('outcome', None) is True
+
+    if debug:
+        return (eval_returned_true, [[result]],)
+    return eval_returned_true
+
 
-def run(inject_evaluation: dict, data: dict, context: dict, debug: bool = False) -> Union[bool, tuple]:
+# The script only defines `evaluate`. It is executed by the agent's harness which feeds it the data and context
+def build_script(inject_evaluation: dict) -> str:
     evaluation_params = inject_evaluation["parameters"]
     evaluation_script = evaluation_params[0]
     lines = evaluation_script.splitlines()
     indentedLines = [f"{PYTHON_INDENT}{l}" for l in lines]
     indentedScript = "\n".join(indentedLines)
     indentedScript = f'{PYTHON_INDENT}return False' if len(indentedScript) == 0 else indentedScript
+    script = f"""
+def evaluate(data: dict, context: dict) -> bool:
+{indentedScript}
+"""
+    return script
+
+
+def getScriptHash(script: str) -> str:
+    return hashlib.sha256(script.encode('utf-8')).hexdigest()
+
+
+async def evaluateInAgent(script: str, data: dict, context: dict) -> dict:
+    script_hash = getScriptHash(script)
+    # Serializing large data can take a while, keep it out of the event loop
+    data_str, context_str, digest = await asyncio.to_thread(encodeInput, script, script_hash, data, context)
+    result = getCachedResult(digest)
+    if result is not None:
+        return result
+
+    body = f'{{"data": {data_str}, "context": {context_str}}}'
+    if script_hash not in KNOWN_SCRIPTS:
+        await registerScript(script)
+    status, result = await postToAgent(f"/evaluate?script={script_hash}", body)
+    if status == 404:  # The agent restarted or evicted the script
+        KNOWN_SCRIPTS.discard(script_hash)
+        await registerScript(script)
+        status, result = await postToAgent(f"/evaluate?script={script_hash}", body)
+    if result['status'] == 'success':
+        setCachedResult(digest, result)
+    return result
+
+
+def encodeInput(script: str, script_hash: str, data: dict, context: dict) -> tuple:
     data_str = json.dumps(data)
     context_str = json.dumps(context)
+    context_fields = getContextFields(script, script_hash)
+    relevant_context_str = context_str if context_fields is None else json.dumps({field: context.get(field, None) for field in context_fields})
+    digest = hashlib.sha256()
+    digest.update(script_hash.encode('utf-8'))
+    digest.update(data_str.encode('utf-8'))
+    digest.update(relevant_context_str.encode('utf-8'))
+    return (data_str, context_str, digest.hexdigest(),)
 
-    # Dump the JSON strings again to ensure proper escaping
-    safe_data_str = json.dumps(data_str)
-    safe_context_str = json.dumps(context_str)
 
-    script = f"""
-import json
+# Context fields read by the script. None if the context is used in any other way, then the whole context is relevant
+def getContextFields(script: str, script_hash: str) -> Union[list, None]:
+    if script_hash not in CONTEXT_FIELDS_BY_SCRIPT:
+        fields = set()
+        for match in CONTEXT_KEY_REGEX.finditer(script):
+            fields.add(match.group(1) or match.group(2))
+        context_uses = len(CONTEXT_USE_REGEX.findall(script)) - 1  # Minus the one of the `evaluate` signature
+        matched_uses = len(CONTEXT_KEY_REGEX.findall(script))
+        CONTEXT_FIELDS_BY_SCRIPT[script_hash] = sorted(fields) if context_uses == matched_uses else None
+    return CONTEXT_FIELDS_BY_SCRIPT[script_hash]
 
-def evaluate(data: dict, context: dict) -> bool:
-{indentedScript}
 
-data = json.loads({safe_data_str})
-context = json.loads({safe_context_str})
-outcome = evaluate(data, context)
-if outcome is True:
-    print('{VALIDATION_TRUE}')
-else:
-    print('{VALIDATION_FALSE}')
-"""
-    result = sendScriptToAgent(script, context)
-    eval_returned_true = VALIDATION_TRUE in result["stdout"]
-    result["stdout"] = result["stdout"].replace(VALIDATION_TRUE, '').replace(VALIDATION_FALSE, '')
+def getCachedResult(digest: str) -> Union[dict, None]:
+    entry = RESULT_CACHE.get(digest, None)
+    if entry is None:
+        RESULT_CACHE_STATS['misses'] += 1
+        return None
+    expires_at, result = entry
+    if time.time() >= expires_at:
+        del RESULT_CACHE[digest]
+        RESULT_CACHE_STATS['expired'] += 1
+        RESULT_CACHE_STATS['misses'] += 1
+        return None
+    RESULT_CACHE.move_to_end(digest)
+    RESULT_CACHE_STATS['hits'] += 1
+    return dict(result)
 
-    if debug:
-        if result['status'] == 'success':
-            return (True, [[result]],) if eval_returned_true else (False, [[result]],)
-        return (False, [[result]],)
-    else:
-        if result['status'] == 'success':
-            return eval_returned_true
-        return False
-
-
-def sendScriptToAgent(script, context) -> dict:
-    conn = http.client.HTTPConnection("localhost", port)
-    payload = {"script": script, "context": context}
-    conn.request("POST", "/", body=json.dumps(payload), headers=headers)
-
-    response = conn.getresponse()
-    result = json.loads(response.read().decode())
-    conn.close()
-    return result
+
+def setCachedResult(digest: str, result: dict):
+    RESULT_CACHE[digest] = (time.time() + RESULT_CACHE_EXPIRE_AFTER, dict(result),)
+    RESULT_CACHE.move_to_end(digest)
+    while len(RESULT_CACHE) > RESULT_CACHE_MAX_ENTRIES:
+        RESULT_CACHE.popitem(last=False)
+        RESULT_CACHE_STATS['evictions'] += 1
+
+
+def getResultCacheStats() -> dict:
+    stats = dict(RESULT_CACHE_STATS)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0
+    stats['cached'] = len(RESULT_CACHE)
+    stats['max_size'] = RESULT_CACHE_MAX_ENTRIES
+    return stats
+
+
+async def registerScript(script: str):
+    status, result = await postToAgent("/scripts", json.dumps({"script": script}))
+    if status == 200:
+        KNOWN_SCRIPTS.add(result['script_hash'])
+
+
+# Cancelling the awaiting task aborts the request. The agent still lets the script run to the end of its cputime limit
+async def postToAgent(path: str, body: str, timeout: float = EVALUATION_TIMEOUT) -> tuple:
+    SANDBOX_STATS['calls'] += 1
+    SANDBOX_STATS['in_flight'] += 1
+    status = 'error'
+    start_time = time.time()
+    try:
+        async with get_session().post(path, data=body, headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            status = response.status
+            if response.status != 200:
+                SANDBOX_STATS['errors'] += 1
+                error = await response.text()
+                return (response.status, failedResult(error),)
+            return (response.status, await response.json(),)
+    except asyncio.TimeoutError:
+        status = 'timeout'
+        SANDBOX_STATS['timeouts'] += 1
+        return (None, failedResult(f"Sandbox evaluation timed out after {timeout}s"),)
+    except asyncio.CancelledError:
+        status = 'cancelled'
+        SANDBOX_STATS['cancelled'] += 1
+        raise
+    except aiohttp.ClientError as e:
+        SANDBOX_STATS['errors'] += 1
+        return (None, failedResult(f"Could not reach the sandbox agent: {e}"),)
+    finally:
+        duration = time.time() - start_time
+        SANDBOX_STATS['in_flight'] -= 1
+        SANDBOX_STATS['total_duration'] += duration
+        SANDBOX_STATS['max_duration'] = max(SANDBOX_STATS['max_duration'], duration)
+        metrics.SANDBOX_DURATION.observe(duration, path=path.split('?', 1)[0], status=status)
+
+
+def failedResult(error: str) -> dict:
+    return {"status": "failure", "outcome": None, "exit_code": None, "stdout": "", "stderr": error, "duration": None}
+
+
+def getClientStats() -> dict:
+    stats = dict(SANDBOX_STATS)
+    stats['avg_duration'] = stats['total_duration'] / max(1, stats['calls'])
+    return stats
+
+
+async def getAgentStats() -> Union[None, dict]:
+    try:
+        async with get_session().get("/stats", timeout=aiohttp.ClientTimeout(total=2)) as response:
+            return await response.json()
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        return None
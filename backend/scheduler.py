@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from typing import Callable, Union
+
+from backend.appConfig import logger
+
+
+class ScheduledHandle:
+    __slots__ = ('key', 'callback', 'delay', 'interval', 'jitter', 'due', 'cancelled', 'task', 'stats')
+
+    def __init__(self, key, callback: Callable, delay: float, interval: Union[float, None], jitter: float, stats: dict):
+        self.key = key
+        self.callback = callback
+        self.delay = delay
+        self.interval = interval
+        self.jitter = jitter
+        self.due = None
+        self.cancelled = False
+        self.task = None
+        self.stats = stats
+
+    def cancel(self):
+        self.cancelled = True
+        self.stats['next_run'] = None
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+
+# Single timer for all scheduled callbacks. Handles are kept in a heap ordered by due time,
+# cancelled handles are dropped lazily when they reach the top of the heap.
+class TimerScheduler:
+
+    def __init__(self):
+        self.heap = []
+        self.handles = {}
+        self.stats = {}
+        self.counter = itertools.count()
+        self.cancelled_count = 0
+        self.wakeup = None
+        self.runner = None
+
+    def schedule(self, key, callback: Callable, delay: float, interval: Union[float, None] = None, jitter: float = 0.0) -> ScheduledHandle:
+        handle = self.handles.get(key, None)
+        if handle is not None:
+            if (handle.delay, handle.interval, handle.jitter,) == (delay, interval, jitter,):
+                handle.callback = callback
+                return handle  # Already scheduled
+            self.cancel(key)  # Timing changed, start over with the new one
+        stats = self.stats.setdefault(key, {
+            'runs': 0,
+            'failures': 0,
+            'last_run': None,
+            'last_duration': None,
+            'total_duration': 0.0,
+            'next_run': None,
+        })
+        handle = ScheduledHandle(key, callback, delay, interval, jitter, stats)
+        self.handles[key] = handle
+        self.push(handle, delay)
+        return handle
+
+    def cancel(self, key):
+        handle = self.handles.pop(key, None)
+        if handle is None:
+            return
+        handle.cancel()
+        self.cancelled_count += 1
+        if self.cancelled_count > len(self.heap) / 2:  # Do not let cancelled handles pile up in the heap
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled_count = 0
+
+    def cancel_all(self):
+        for handle in self.handles.values():
+            handle.cancel()
+        self.handles = {}
+        self.heap = []
+        self.cancelled_count = 0
+
+    def get_stats(self) -> dict:
+        now = time.time()
+        stats = {}
+        for key, key_stats in self.stats.items():
+            key_stats = dict(key_stats)
+            key_stats['scheduled'] = key in self.handles
+            key_stats['running'] = key in self.handles and self.handles[key].task is not None
+            if key_stats['next_run'] is not None:
+                key_stats['next_run_in'] = max(0, key_stats['next_run'] - now)
+            stats['-'.join(key)] = key_stats
+        return stats
+
+    def push(self, handle: ScheduledHandle, delay: float):
+        if handle.jitter > 0:
+            delay += random.uniform(0, handle.jitter)
+        handle.due = time.monotonic() + delay
+        handle.stats['next_run'] = time.time() + delay
+        heapq.heappush(self.heap, (handle.due, next(self.counter), handle,))
+        self.ensure_running()
+        self.wakeup.set()
+
+    def ensure_running(self):
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if self.runner is None or self.runner.done():
+            self.runner = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            self.wakeup.clear()
+            now = time.monotonic()
+            while len(self.heap) > 0 and (self.heap[0][2].cancelled or self.heap[0][0] <= now):
+                _, _, handle = heapq.heappop(self.heap)
+                if handle.cancelled:
+                    self.cancelled_count = max(0, self.cancelled_count - 1)
+                    continue
+                handle.stats['next_run'] = None
+                handle.task = asyncio.ensure_future(self.execute(handle))
+            timeout = self.heap[0][0] - now if len(self.heap) > 0 else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def execute(self, handle: ScheduledHandle):
+        start_time = time.time()
+        try:
+            await handle.callback()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            handle.stats['failures'] += 1
+            logger.error(f"Scheduled task {handle.key} failed: {e}")
+        finally:
+            duration = time.time() - start_time
+            handle.stats['runs'] += 1
+            handle.stats['last_run'] = start_time
+            handle.stats['last_duration'] = duration
+            handle.stats['total_duration'] += duration
+            handle.task = None
+
+        if handle.cancelled:
+            return
+        if handle.interval is not None:
+            self.push(handle, handle.interval)  # The next run is counted from the end of this one
+        elif self.handles.get(handle.key, None) is handle:
+            del self.handles[handle.key]
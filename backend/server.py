@@ -3,6 +3,7 @@
 import base64
 import collections
 import functools
+import hmac
 import json
 import argparse
 import os
@@ -12,12 +13,11 @@ import atexit
 from pathlib import Path
 import sys
 import time
-import traceback
 import zmq
 import socketio
+from socketio import packet as socketio_packet
 from aiohttp import web
 import zmq.asyncio
-from random import getrandbits
 
 from aiohttp_session import setup as setup_session, get_session
 from aiohttp_session.cookie_storage import EncryptedCookieStorage
@@ -27,9 +27,19 @@ sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 import backend.exercise as exercise_model
 import backend.notification as notification_model
 import backend.db as db
+import backend.leaderboard as leaderboard
 import backend.config as config
-from backend.appConfig import logger, admin_settings
+from backend.appConfig import logger, admin_settings, evaluation_settings, ingest_settings, loop_monitor_settings, progress_settings
 import backend.misp_api as misp_api
+import backend.metrics as metrics
+import backend.profiler as profiler
+import backend.sandboxClient as sandboxClient
+from backend.utils import compute_patch, get_jq_cache_stats
+from backend.inject_plan import get_routing_stats
+from backend.scheduler import TimerScheduler
+from backend.ingest import IngestPipeline, MessageFilter, decode_json
+from backend.replay import ReplayEngine
+from backend.loopmonitor import LoopMonitor
 
 from backend.target_tools.misp.exercise import is_accepted_query as is_accepted_query_misp
 from backend.target_tools.suricata.exercise import getInstalledSuricataVersion
@@ -40,15 +50,32 @@ WEB_DIST_DIR = os.path.abspath(os.path.dirname(os.path.abspath(__file__)) + '/..
 DEBUG = False
 ZMQ_LOG_FILE = None
 ZMQ_START_LINE_NUMBER = 0
+ZMQ_REPLAY_SPEED = None
+REPLAY_ENGINE = None
 ZMQ_MESSAGE_COUNT_LAST_TIMESPAN = 0
 ZMQ_MESSAGE_COUNT = 0
 ZMQ_LAST_TIME = None
 USER_ACTIVITY = collections.defaultdict(int)
+LOOP_MONITOR = LoopMonitor(
+    loop_monitor_settings['interval_sec'],
+    loop_monitor_settings['slow_callback_threshold_sec'],
+    loop_monitor_settings['max_slow_callbacks'],
+    loop_monitor_settings['lag_history_size'],
+)
+# Last progress and statistics broadcasted to clients. Clients receive patches against this state
+PROGRESS_STATE = None
+PROGRESS_VERSION = 0
+PROGRESS_STATE_VERSION = None  # Value of `db.STATE_VERSION` when PROGRESS_STATE was computed
+# Clients join PATCH_ROOM when they fetch a progress snapshot, the others are considered to be legacy clients
+PATCH_ROOM = 'progress_patch'
+LEGACY_ROOM = 'progress_legacy'
+LEGACY_CLIENTS = set()
 ALLOWED_TARGET_TOOLS = ["MISP", 'suricata', 'webhook']
 
-# Each running timed injects will look in this list if they should be still running.
-# If it's not, it will stop. (Based on inject_uuid, trigger_type and random ID)
-RUNNING_TIMED_INJECTS = []
+INGEST_PIPELINE = None
+MESSAGE_FILTER = MessageFilter(ingest_settings['topics'], ingest_settings['markers'])
+# Timed injects are scheduled by (trigger_type, inject_uuid)
+TIMED_INJECT_SCHEDULER = TimerScheduler()
 
 
 def debounce(debounce_seconds: int = 1):
@@ -70,20 +97,6 @@ def debounce(debounce_seconds: int = 1):
     return decorator
 
 
-def timer():
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            t1 = time.time()
-            res = func(*args, **kwargs)
-            elapsed = time.time() - t1
-            if elapsed > 0.1:
-                print(elapsed)
-            return res
-        return wrapper
-    return decorator
-
-
 # Initialize ZeroMQ context and subscriber socket
 context = zmq.asyncio.Context()
 zsocket = context.socket(zmq.SUB)
@@ -95,7 +108,19 @@ zsocket.setsockopt_string(zmq.SUBSCRIBE, '')
 app = web.Application()
 secret_key = base64.urlsafe_b64decode(base64.urlsafe_b64encode(os.urandom(32)))
 setup_session(app, EncryptedCookieStorage(secret_key))
-sio = socketio.AsyncServer(cors_allowed_origins='*', async_mode='aiohttp')
+# Records the size of the packets as they are encoded. Broadcasted packets are encoded once for all clients
+class MeasuredPacket(socketio_packet.Packet):
+
+    def encode(self):
+        encoded_packet = super().encode()
+        if self.packet_type in (socketio_packet.EVENT, socketio_packet.ACK):
+            event = self.data[0] if self.packet_type == socketio_packet.EVENT and self.data else 'ack'
+            size = sum(len(part) for part in encoded_packet) if isinstance(encoded_packet, list) else len(encoded_packet)
+            metrics.EMIT_SIZE.observe(size, event=event)
+        return encoded_packet
+
+
+sio = socketio.AsyncServer(cors_allowed_origins='*', async_mode='aiohttp', serializer=MeasuredPacket)
 sio.attach(app)
 
 
@@ -125,6 +150,7 @@ async def auth_middleware(request, handler):
         "/webhook",
         "/favicon.ico",
         "/socket.io/",
+        "/metrics",  # Authenticates scrapers itself
     ) or request.path.startswith("/assets"):
         return await handler(request)
 
@@ -200,6 +226,40 @@ async def login(request):
     else:
         return web.Response(text="Invalid credentials", status=401)
 
+# Prometheus scrapers can authenticate with basic auth using the admin credentials
+async def metrics_handler(request):
+    session = await get_session(request)
+    if not session.get("user") and not is_valid_basic_auth(request.headers.get("Authorization", "")):
+        return web.Response(text="Unauthorized", status=401, headers={"WWW-Authenticate": 'Basic realm="SkillAegis"'})
+    return web.Response(text=metrics.render_prometheus(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+def is_valid_basic_auth(authorization: str) -> bool:
+    scheme, _, encoded_credentials = authorization.partition(" ")
+    if scheme.lower() != "basic":
+        return False
+    try:
+        username, _, password = base64.b64decode(encoded_credentials).decode("utf-8").partition(":")
+    except (ValueError, UnicodeDecodeError):
+        return False
+    return (
+        hmac.compare_digest(admin_settings["credentials"]["username"].encode("utf-8"), username.encode("utf-8"))
+        and hmac.compare_digest(admin_settings["credentials"]["password"].encode("utf-8"), password.encode("utf-8"))
+    )
+
+async def export_loop_monitor(request):
+    filename = f"skillaegis-loop-monitor-{int(time.time())}.json"
+    return web.json_response(LOOP_MONITOR.export(), headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+async def inject_profiles(request):
+    return web.json_response(profiler.get_report(parse_report_limit(request.query.get('limit', None))))
+
+def parse_report_limit(limit):
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        return None
+    return limit if limit >= 0 else None
+
 async def logout(request):
     session = await get_session(request)
     session.invalidate()
@@ -208,10 +268,15 @@ async def logout(request):
 
 @sio.event
 async def connect(sid, environ):
+    metrics.CONNECTED_CLIENTS.inc()
+    LEGACY_CLIENTS.add(sid)
+    await sio.enter_room(sid, LEGACY_ROOM)
     logger.debug("Client connected: %s", sid)
 
 @sio.event
 async def disconnect(sid):
+    metrics.CONNECTED_CLIENTS.dec()
+    LEGACY_CLIENTS.discard(sid)
     logger.debug("Client disconnected: %s", sid)
 
 @sio.event
@@ -240,6 +305,19 @@ async def get_progress(sid):
 async def get_users_stats(sid):
     return exercise_model.get_users_stats()
 
+@sio.event
+async def get_progress_snapshot(sid):
+    if sid in LEGACY_CLIENTS:
+        LEGACY_CLIENTS.discard(sid)
+        await sio.leave_room(sid, LEGACY_ROOM)
+        await sio.enter_room(sid, PATCH_ROOM)
+    await sendRefreshScoreIfDirty()
+    return {
+        'version': PROGRESS_VERSION,
+        'progress': PROGRESS_STATE['progress'],
+        'statistics': PROGRESS_STATE['statistics'],
+    }
+
 @sio.event
 async def get_notifications(sid):
     return notification_model.get_notifications()
@@ -278,6 +356,22 @@ async def reset_notifications(sid):
 async def get_diagnostic(sid):
     return await getDiagnostic()
 
+@sio.event
+@require_auth
+async def get_slow_callbacks(sid):
+    return LOOP_MONITOR.export()
+
+@sio.event
+@require_auth
+async def get_inject_profiles(sid, payload={}):
+    return profiler.get_report(parse_report_limit(payload.get('limit', None)) if isinstance(payload, dict) else None)
+
+@sio.event
+@require_auth
+async def reset_inject_profiles(sid):
+    profiler.reset_profiles()
+    return profiler.get_report()
+
 @sio.event
 async def get_users_activity(sid):
     return notification_model.get_users_activity()
@@ -306,10 +400,14 @@ async def reload_from_disk(sid):
 async def any_event(event, sid, data={}):
     logger.info('>> Unhandled event %s', event)
 
-async def handleMessage(topic, s, message):
-    global ZMQ_MESSAGE_COUNT_LAST_TIMESPAN
+# Messages of a user are handled in order by the same ingest worker
+def get_message_shard_key(topic, data):
+    return notification_model.get_user_id(data)
+
 
-    data = json.loads(message)
+@metrics.timed(metrics.HANDLER_DURATION, handler='zmq')
+async def handleMessageData(topic, data):
+    global ZMQ_MESSAGE_COUNT_LAST_TIMESPAN
 
     if topic == 'misp_json_audit':
         user_id, email = notification_model.get_user_email_id_pair(data)
@@ -317,6 +415,7 @@ async def handleMessage(topic, s, message):
             if user_id not in db.USER_ID_TO_EMAIL_MAPPING:
                 db.USER_ID_TO_EMAIL_MAPPING[user_id] = email
                 db.EMAIL_TO_USER_ID_MAPPING[email] = user_id
+                db.bumpStateVersion()
                 await sio.emit('new_user', email)
 
         user_id, authkey = notification_model.get_user_authkey_id_pair(data)
@@ -348,6 +447,7 @@ async def handleMessage(topic, s, message):
                         await sendRefreshScoreTask if sendRefreshScoreTask is not None else None  # Make sure check_active_tasks was not debounced
 
 
+@metrics.timed(metrics.HANDLER_DURATION, handler='webhook')
 async def handleWebhook(data):
     global ZMQ_MESSAGE_COUNT_LAST_TIMESPAN
 
@@ -358,6 +458,7 @@ async def handleWebhook(data):
         if user_id not in db.USER_ID_TO_EMAIL_MAPPING:
             db.USER_ID_TO_EMAIL_MAPPING[user_id] = email
             db.EMAIL_TO_USER_ID_MAPPING[email] = user_id
+            db.bumpStateVersion()
             await sio.emit("new_user", email)
         else:
             email = db.USER_ID_TO_EMAIL_MAPPING.get(user_id, None)
@@ -419,10 +520,55 @@ async def handleWebhook(data):
 
 @debounce(debounce_seconds=0)
 async def sendRefreshScore():
-    progress = exercise_model.get_progress()
-    await sio.emit('update_progress', progress)
-    users_stats = exercise_model.get_users_stats()
-    await sio.emit("update_statistics", users_stats)
+    base_version = PROGRESS_VERSION
+    operations = update_progress_state()
+    if len(operations) == 0:
+        await sio.emit('progress_version', {'version': PROGRESS_VERSION}, room=PATCH_ROOM)
+    else:
+        await sio.emit('progress_patch', {
+            'base_version': base_version,
+            'version': PROGRESS_VERSION,
+            'operations': operations,
+        }, room=PATCH_ROOM)
+        if progress_settings['legacy_full_payloads'] and len(LEGACY_CLIENTS) > 0:
+            await sio.emit('update_progress', PROGRESS_STATE['progress'], room=LEGACY_ROOM)
+            await sio.emit('update_statistics', PROGRESS_STATE['statistics'], room=LEGACY_ROOM)
+
+
+async def sendRefreshScoreIfDirty() -> bool:
+    if not is_progress_state_dirty():
+        return False
+    await sendRefreshScore()
+    return True
+
+
+def is_progress_state_dirty() -> bool:
+    # The leaderboard snapshot also expires when a time based metric such as being on fire or a notification based
+    # trophy changes
+    return (
+        PROGRESS_STATE is None
+        or PROGRESS_STATE_VERSION != db.STATE_VERSION
+        or not leaderboard.is_leaderboard_snapshot_valid(exercise_model.get_selected_exercises(), exercise_model.get_completion_for_users())
+    )
+
+
+def update_progress_state() -> list:
+    global PROGRESS_STATE, PROGRESS_VERSION, PROGRESS_STATE_VERSION
+
+    new_state = {
+        'progress': exercise_model.get_progress(),
+        'statistics': exercise_model.get_users_stats(),
+    }
+    new_state = json.loads(json.dumps(new_state))  # Deep copy with the keys as clients will see them
+    PROGRESS_STATE_VERSION = db.STATE_VERSION
+    if PROGRESS_STATE is None:
+        operations = [['set', [], new_state]]
+    else:
+        operations = compute_patch(PROGRESS_STATE, new_state)
+    if len(operations) > 0:
+        PROGRESS_STATE = new_state
+        PROGRESS_VERSION += 1
+    return operations
 
 
 async def sendUserInjectCheckInProgress(user: int, inject_uuid: str):
@@ -460,6 +606,24 @@ async def getDiagnostic() -> dict:
         'url': config.misp_url,
         'apikey': config.misp_apikey[0:4] + '*'*32 + config.misp_apikey[36:],
     }
+    diagnostic['jq_cache'] = get_jq_cache_stats()
+    diagnostic['inject_routing'] = get_routing_stats()
+    diagnostic['misp_fetch'] = misp_api.get_fetch_stats()
+    diagnostic['timed_injects'] = TIMED_INJECT_SCHEDULER.get_stats()
+    diagnostic['sandbox'] = {
+        'agent': await sandboxClient.getAgentStats(),
+        'client': sandboxClient.getClientStats(),
+        'result_cache': sandboxClient.getResultCacheStats(),
+    }
+    diagnostic['loop_lag'] = get_loop_lag_stats()
+    diagnostic['slow_callbacks'] = {
+        'summary': LOOP_MONITOR.get_slow_callback_summary(),
+        'recent': LOOP_MONITOR.get_slow_callbacks()[-10:],
+    }
+    diagnostic['ingest'] = INGEST_PIPELINE.get_stats() if INGEST_PIPELINE is not None else None
+    diagnostic['ingest_filter'] = MESSAGE_FILTER.get_stats()
+    diagnostic['replay'] = REPLAY_ENGINE.get_stats() if REPLAY_ENGINE is not None else None
+    diagnostic['metrics'] = metrics.get_summary()
     misp_version = await misp_api.getVersion()
     if misp_version is None:
         diagnostic['online'] = False
@@ -505,11 +669,20 @@ async def keepalive():
     global ZMQ_LAST_TIME
     while True:
         await sio.sleep(5)
+        await sendRefreshScoreIfDirty()
         payload = {
             'zmq_last_time': ZMQ_LAST_TIME,
+            'progress_version': PROGRESS_VERSION,
         }
         await sio.emit('keep_alive', payload)
-        await sendRefreshScore()
+
+
+async def monitor_loop_lag():
+    await LOOP_MONITOR.run()
+
+
+def get_loop_lag_stats() -> dict:
+    return LOOP_MONITOR.get_stats()
 
 
 async def backup_exercises_progress():
@@ -522,7 +695,7 @@ def start_sandbox_agent():
     bin_path = os.path.abspath("./venv/bin/python3")
     script_path = os.path.abspath("./backend/sandboxAgent.py")
     process = subprocess.Popen(
-        [bin_path, script_path],
+        [bin_path, script_path, '--pool_size', str(sandboxClient.POOL_SIZE)],
         preexec_fn=os.setsid,
         stdout=subprocess.DEVNULL,
         stderr=subprocess.DEVNULL
@@ -532,72 +705,55 @@ def start_sandbox_agent():
 
 
 def start_timed_injects():
-    global RUNNING_TIMED_INJECTS
-
     full_selected_exercises = [exercise for exercise in exercise_model.get_all_exercises() if exercise['exercise']['uuid'] in exercise_model.get_selected_exercises()]
     selected_inject_flows = []
     for exercise in full_selected_exercises:
         for inject_flow in exercise['inject_flow']:
             selected_inject_flows.append(inject_flow)
 
-    stop_all_timed_injects()
-
+    timed_injects = {}
     for injectF in selected_inject_flows:
         triggers = injectF.get("sequence", {}).get("trigger", [])
         if ('periodic' in triggers or 'triggered_at' in triggers) and "timing" in injectF:
             for trigger_type, value in injectF['timing'].items():
-                if trigger_type == 'triggered_at' and value is not None:
-                    start_timed_inject(injectF, trigger_type, value)
-                if trigger_type == 'periodic_run_every' and value is not None:
-                    start_timed_inject(injectF, trigger_type, value)
+                if trigger_type in ['triggered_at', 'periodic_run_every'] and value is not None:
+                    timed_injects[(trigger_type, injectF['inject_uuid'],)] = (injectF, trigger_type, value,)
+
+    # Timed injects of exercises that are still selected keep their schedule, unless their timing changed
+    for key in list(TIMED_INJECT_SCHEDULER.handles.keys()):
+        if key not in timed_injects:
+            TIMED_INJECT_SCHEDULER.cancel(key)
+    for injectF, trigger_type, value in timed_injects.values():
+        start_timed_inject(injectF, trigger_type, value)
 
 
 def start_timed_inject(injectF, trigger_type, value):
-    global RUNNING_TIMED_INJECTS
-    if f"{trigger_type}-{injectF['inject_uuid']}" in RUNNING_TIMED_INJECTS:
-        return  # Timed inject already running
-    random_bits = getrandbits(32)
-    uniq_str = f"{trigger_type}-{injectF['inject_uuid']}_{random_bits}"
-    RUNNING_TIMED_INJECTS.append(uniq_str)
-    sio.start_background_task(timed_inject, injectF, trigger_type, value, random_bits)
+    key = (trigger_type, injectF['inject_uuid'],)
+    callback = functools.partial(timed_inject, injectF, trigger_type)
+    if trigger_type == 'triggered_at':
+        TIMED_INJECT_SCHEDULER.schedule(key, callback, value)
+    elif trigger_type == 'periodic_run_every':
+        TIMED_INJECT_SCHEDULER.schedule(key, callback, value, interval=value, jitter=evaluation_settings['timed_inject_jitter_sec'])
 
 
 def stop_all_timed_injects():
-    global RUNNING_TIMED_INJECTS
-    RUNNING_TIMED_INJECTS = []
+    TIMED_INJECT_SCHEDULER.cancel_all()
 
 
-async def timed_inject(injectF, trigger_type, value, random_bits):
-    global RUNNING_TIMED_INJECTS
-
+async def timed_inject(injectF, trigger_type):
     inject = db.INJECT_BY_UUID.get(injectF['inject_uuid'], None)
     if inject is None:
         return
 
-    uniq_str = f"{trigger_type}-{injectF['inject_uuid']}_{random_bits}"
-    if trigger_type == 'triggered_at':
-        seconds = value
-        await sio.sleep(seconds)
-        if uniq_str not in RUNNING_TIMED_INJECTS:
-            return  # Timed inject has been stopped
-
-    elif trigger_type == 'periodic_run_every':
-        seconds = value
-        while True:
-            await sio.sleep(seconds)
-            if uniq_str not in RUNNING_TIMED_INJECTS:
-                return  # Timed inject has been stopped
-
-            data = {}
-            context = {
-                'evaluation_trigger': trigger_type,
-                'request_is_rest': False  # User did not perform the request since we're in timed inject context
-            }
-            checking_task = exercise_model.check_inject_for_timed_inject(inject, data, context)
-            if checking_task is not None:  # Make sure check_active_tasks was not debounced
-                succeeded_once = await checking_task
-                if succeeded_once:
-                    await sendRefreshScore()
+    if trigger_type == 'periodic_run_every':
+        data = {}
+        context = {
+            'evaluation_trigger': trigger_type,
+            'request_is_rest': False  # User did not perform the request since we're in timed inject context
+        }
+        succeeded_once = await exercise_model.check_inject_for_timed_inject(inject, data, context)
+        if succeeded_once:
+            await sendRefreshScore()
 
 
 # Function to forward zmq messages to Socket.IO
@@ -605,65 +761,53 @@ async def forward_zmq_to_socketio():
     global ZMQ_MESSAGE_COUNT, ZMQ_LAST_TIME
 
     while True:
-        message = await zsocket.recv_string()
-        topic, s, m = message.partition(" ")
+        message = await zsocket.recv()
+        topic, s, m = message.partition(b" ")
         try:
-            ZMQ_MESSAGE_COUNT += 1
-            ZMQ_LAST_TIME = time.time()
-            await handleMessage(topic, s, m)
+            await ingestMessage(topic.decode('utf-8', 'replace'), m)
         except Exception as e:
             print(e)
-            logger.error('Error handling message %s', e)
+            logger.error('Error decoding message %s', e)
+
+
+async def ingestMessage(topic: str, raw: bytes):
+    global ZMQ_MESSAGE_COUNT, ZMQ_LAST_TIME
+    ZMQ_MESSAGE_COUNT += 1
+    ZMQ_LAST_TIME = time.time()
+    metrics.ZMQ_MESSAGES.inc(topic=topic)
+    metrics.ZMQ_BYTES.inc(len(raw), topic=topic)
+    if not MESSAGE_FILTER.accept(topic, raw):
+        return
+    data = decode_json(raw)
+    await INGEST_PIPELINE.submit(topic, data)  # Waits only when the pipeline applies backpressure
 
 
 # Function to forward zmq messages to Socket.IO
 async def forward_fake_zmq_to_socketio():
-    global ZMQ_MESSAGE_COUNT, ZMQ_LAST_TIME, ZMQ_LOG_FILE, ZMQ_START_LINE_NUMBER
-    filename = ZMQ_LOG_FILE
-    start_line_number = ZMQ_START_LINE_NUMBER
-    line_number = sum(1 for _ in open(filename))
-    print(f'Preparing to feed {line_number} lines..')
-    print(f'Starting from line {start_line_number}.')
+    global REPLAY_ENGINE
     await sio.sleep(2)
+    REPLAY_ENGINE = ReplayEngine(ZMQ_LOG_FILE, ingestMessage, ZMQ_REPLAY_SPEED, ZMQ_START_LINE_NUMBER, lambda: INGEST_PIPELINE.stats['errors'])
+    await REPLAY_ENGINE.run()
 
-    print('Feeding started')
-    line_count = 0
-    last_print = time.time()
-    with open(filename) as f:
-        for line in f:
-            line_count += 1
-            if line_count-1 < start_line_number:
-                continue
-            now = time.time()
-            if line_count % (int(line_number/100)) == 0 or (now - last_print >= 5):
-                last_print = now
-                print(f'Feeding {line_count} / {line_number} - ({100* line_count / line_number:.1f}%)')
-            split = line.split(' ', 1)
-            topic = split[0]
-            s = ''
-            m = split[1]
-            if topic != 'misp_json_self':
-                await sio.sleep(0.01)
-            try:
-                ZMQ_MESSAGE_COUNT += 1
-                ZMQ_LAST_TIME = time.time()
-                await handleMessage(topic, s, m)
-            except Exception as e:
-                print(e)
-                print(line)
-                print(traceback.format_exc())
-                logger.error('Error handling message: %s', e)
-                await sio.sleep(5)
-    print('Feeding done.')
-
-
-async def init_app(zmq_log_file=None, zmq_start_line_number: int = 0, debug=False):
-    global ZMQ_LOG_FILE, ZMQ_START_LINE_NUMBER, DEBUG
+
+async def close_misp_session(app):
+    await misp_api.close_session()
+
+
+async def close_sandbox_session(app):
+    await sandboxClient.close_session()
+
+
+async def init_app(zmq_log_file=None, zmq_start_line_number: int = 0, debug=False, zmq_replay_speed=None):
+    global ZMQ_LOG_FILE, ZMQ_START_LINE_NUMBER, ZMQ_REPLAY_SPEED, DEBUG, INGEST_PIPELINE
 
     DEBUG = debug
+    INGEST_PIPELINE = IngestPipeline(handleMessageData, get_message_shard_key, ingest_settings['workers'], ingest_settings['queue_size'], ingest_settings['backpressure'])
+    INGEST_PIPELINE.start()
     if zmq_log_file is not None:
         ZMQ_LOG_FILE = zmq_log_file
         ZMQ_START_LINE_NUMBER = zmq_start_line_number
+        ZMQ_REPLAY_SPEED = zmq_replay_speed
         sio.start_background_task(forward_fake_zmq_to_socketio)
     else:
         exercise_model.restore_exercices_progress()
@@ -672,7 +816,10 @@ async def init_app(zmq_log_file=None, zmq_start_line_number: int = 0, debug=Fals
     sio.start_background_task(notification_history)
     sio.start_background_task(record_users_activity)
     sio.start_background_task(backup_exercises_progress)
+    sio.start_background_task(monitor_loop_lag)
     start_sandbox_agent()
+    app.on_cleanup.append(close_misp_session)
+    app.on_cleanup.append(close_sandbox_session)
 
     start_timed_injects()
 
@@ -684,4 +831,7 @@ app.router.add_get('/', index)
 app.router.add_get('/favicon.ico', favicon)
 app.router.add_post('/webhook', webhook)
 app.router.add_post('/login', login)
+app.router.add_get('/metrics', metrics_handler)
+app.router.add_get('/loop_monitor/export', export_loop_monitor)
+app.router.add_get('/inject_profiles', inject_profiles)
 app.router.add_route("OPTIONS", "/{tail:.*}", options_handler)
@@ -49,7 +49,7 @@ async def inject_checker_router(user_id: int, inject_evaluation: dict, data: dic
     elif inject_evaluation['evaluation_strategy'] == 'query_search':
         return eval_query_search(user_id, inject_evaluation, data_to_validate, context)
     elif inject_evaluation['evaluation_strategy'] == 'python':
-        return eval_python(user_id, inject_evaluation, data_to_validate, context)
+        return await eval_python(user_id, inject_evaluation, data_to_validate, context)
     return False
 
 
@@ -103,6 +103,34 @@ def get_model_action(data: dict):
     return (None, None,)
 
 
+# Messages are routed either by the audited model or by the scope of the requested URL
+def get_message_route(data: dict) -> tuple:
+    model, action = get_model_action(data)
+    if model is not None:
+        return ('audit', model,)
+    url = data.get('url', None)
+    if url is not None:
+        split = url.split('/')
+        return ('url', split[1] if len(split) > 1 else None,)
+    return (None, None,)
+
+
+# Routes of the messages for which the inject evaluation could succeed. `*` matches any message
+def get_evaluation_routes(inject_evaluation: dict) -> set:
+    strategy = inject_evaluation.get('evaluation_strategy', None)
+    if strategy == 'data_filtering':
+        return {('audit', '*',)}  # The event to validate is taken from the audit log
+    elif strategy == 'query_mirror':
+        query_context = inject_evaluation.get('evaluation_context', {}).get('query_context', None)
+        if query_context is None:
+            return set()
+        split = query_context.get('url', '').split('/')
+        return {('url', split[1] if len(split) > 1 else None,)}  # The performed query must target the same scope
+    elif strategy in ['query_search', 'python']:
+        return {'*'}  # The data to validate is fetched regardless of the message
+    return set()
+
+
 def is_accepted_query(data: dict) -> bool:
     model, action = get_model_action(data)
     if model in ['Event', 'Attribute', 'Object', 'Tag', ]:
@@ -187,6 +215,7 @@ async def fetch_data_for_query_mirror(user_id: int, inject_evaluation: dict, per
     return data
 
 
+# Always performed with the user's authkey: results depend on the user's ACLs, so they are only shared between identical queries of the same user
 async def fetch_data_for_query_search(user_id: int, inject_evaluation: dict) -> Union[None, dict]:
     authkey = await get_api_key_or_gen_new_one(user_id)
     if 'evaluation_context' not in inject_evaluation and 'query_context' not in inject_evaluation['evaluation_context']:
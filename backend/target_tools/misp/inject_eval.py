@@ -2,6 +2,7 @@
 
 
 from typing import Union
+import backend.profiler as profiler
 from backend.utils import (
     eval_data_filtering as eval_data_filtering_util,
     eval_python as eval_python_util,
@@ -16,7 +17,8 @@ def eval_data_filtering(user_id: int, inject_evaluation: dict, data: dict, conte
 
 ## Query mirror
 def eval_query_mirror(user_id: int, expected_data, data_to_validate, context: dict) -> bool:
-    return expected_data == data_to_validate
+    with profiler.phase('condition'):
+        return expected_data == data_to_validate
 
 
 ## Query search
@@ -24,5 +26,5 @@ def eval_query_search(user_id: int, inject_evaluation: dict, data: dict, context
     return eval_data_filtering(user_id, inject_evaluation, data, context, debug = debug)
 
 ## Python
-def eval_python(user_id: int, inject_evaluation: dict, data: dict, context: dict, debug: bool = False) -> bool:
-    return eval_python_util(inject_evaluation, data, context, debug=debug)
+async def eval_python(user_id: int, inject_evaluation: dict, data: dict, context: dict, debug: bool = False) -> bool:
+    return await eval_python_util(inject_evaluation, data, context, debug=debug)
@@ -3,9 +3,8 @@ import os
 from typing import Union
 import subprocess
 import json
-import jq
 
-from backend.utils import eval_data_filtering
+from backend.utils import eval_data_filtering, get_jq_program
 from backend.appConfig import logger
 import backend.db as db
 import backend.misp_api as misp_api
@@ -101,7 +100,7 @@ def getSuricataEventsWithVerdict() -> list:
     with open(eveFile) as f:
         events = f.read()
         path = '. | select(.verdict.action=="drop" and .alert.signature ) | .'
-        query = jq.compile(path).input_text(events)
+        query = get_jq_program(path).input_text(events)
         verdicts = query.all()
     return verdicts
 
@@ -3,7 +3,7 @@ import json
 from typing import Union
 import jq
 
-from backend.utils import apply_replacement_from_context, eval_data_filtering, eval_python
+from backend.utils import Template, eval_data_filtering, eval_python
 from backend.appConfig import logger
 import backend.db as db
 from backend.target_tools.misp.exercise import fetch_data_for_query_search
@@ -15,8 +15,8 @@ async def inject_checker_router(user_id: int, inject_evaluation: dict, data: dic
         return outcome
     elif inject_evaluation["evaluation_strategy"] == "misp_query_search":
         context['webhook_data'] = data
-        inject_evaluation = doReplacementOnQueryContext(inject_evaluation, context)
-        data_to_validate = await fetch_data_for_query_search(user_id, inject_evaluation)
+        query_evaluation = doReplacementOnQueryContext(inject_evaluation, context)
+        data_to_validate = await fetch_data_for_query_search(user_id, query_evaluation)
         if data_to_validate is None:
             logger.debug('Could not fetch data to validate')
             return False
@@ -24,13 +24,17 @@ async def inject_checker_router(user_id: int, inject_evaluation: dict, data: dic
         return outcome
     elif inject_evaluation["evaluation_strategy"] == "python":
         data_to_validate = data
-        outcome, d = eval_python(inject_evaluation, data_to_validate, context, True)
+        outcome, d = await eval_python(inject_evaluation, data_to_validate, context, True)
         return outcome
     return False
 
 
+# Returns a copy of the inject evaluation with the substitution applied, the scenario itself is left untouched
 def doReplacementOnQueryContext(inject_evaluation, context):
-    query_context_str = json.dumps(inject_evaluation["evaluation_context"]["query_context"])
-    interpolated_query_context = json.loads(apply_replacement_from_context(query_context_str, context))
-    inject_evaluation["evaluation_context"]["query_context"] = interpolated_query_context
-    return inject_evaluation
+    query_context_template = getattr(inject_evaluation, 'query_context_template', None)  # Parsed at load time for evaluation plans
+    if query_context_template is None:
+        query_context_template = Template(json.dumps(inject_evaluation["evaluation_context"]["query_context"]))
+    interpolated_query_context = json.loads(query_context_template.render(context))
+    evaluation_context = dict(inject_evaluation["evaluation_context"])
+    evaluation_context["query_context"] = interpolated_query_context
+    return {**inject_evaluation, "evaluation_context": evaluation_context}
@@ -11,6 +11,8 @@ class Trophy(ABC):
     name = "name"
     description = "description every exercise"
     icon_path = "icon_path"
+    # Trophies earned from the live feed. Their holders are given by `get_notification_earners()`
+    uses_notifications = False
 
     def is_earned_for_users(
         self, selected_exercices: list, completion_for_users: dict
@@ -34,6 +36,9 @@ class Trophy(ABC):
                             user_that_got_the_trophy.add(user_id)
         return user_trophies
 
+    def get_notification_earners(self) -> frozenset:
+        return frozenset()
+
     @abstractmethod
     def is_earned(self, user_id: int, tasks_completion: dict) -> bool:
         pass
@@ -8,11 +8,15 @@ class MessengerTrophy(Trophy):
     name = "Messenger"
     description = "Post a message to the dashboard"
     icon_path = "assets/chatty_gold.png"
+    uses_notifications = True
 
-    def is_earned(self, user_id: int, tasks_completion: dict) -> bool:
-        notifications = get_notifications()
-        for notification in notifications:
-            if notification.get('user_id') == user_id and notification.get('target_tool') == 'webhook':
+    def get_notification_earners(self) -> frozenset:
+        earners = set()
+        for notification in get_notifications():
+            if notification.get('target_tool') == 'webhook':
                 if 'message' in notification and notification['message'].get('text'):
-                    return True
-        return False
+                    earners.add(notification.get('user_id'))
+        return frozenset(earners)
+
+    def is_earned(self, user_id: int, tasks_completion: dict) -> bool:
+        return user_id in self.get_notification_earners()
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+from collections import Counter
 from backend.notification import get_notifications
 from backend.trophies.AbstractTrophy import Trophy
 
@@ -8,11 +9,15 @@ class SpammerTrophy(Trophy):
     name = "Spammer"
     description = "Contribute over 50% of total visible activity in the live feed"
     icon_path = "assets/bell-notifications.png"
+    uses_notifications = True
 
-    def is_earned(self, user_id: int, tasks_completion: dict) -> bool:
+    def get_notification_earners(self) -> frozenset:
         notifications = get_notifications()
         if len(notifications) < 30:
-            return False
+            return frozenset()
+
+        notification_count_by_user = Counter(notif['user_id'] for notif in notifications)
+        return frozenset(user_id for user_id, count in notification_count_by_user.items() if count >= (len(notifications) / 2))
 
-        user_notification_count = len([1 for notif in notifications if notif['user_id'] == user_id])
-        return user_notification_count >= (len(notifications) / 2)
+    def is_earned(self, user_id: int, tasks_completion: dict) -> bool:
+        return user_id in self.get_notification_earners()
@@ -1,56 +1,134 @@
 #!/usr/bin/env python3
 
+import asyncio
+import collections
 import functools
 import time
 from typing import Union
 import jq
 import re
 import operator
+import os
+import subprocess
 import backend.sandboxClient as sandboxClient
+import backend.profiler as profiler
 
 from backend.appConfig import logger
 
+JQ_CACHE_SIZE = 512
+# Programs for the static paths of the loaded exercises. They are compiled once and never evicted
+JQ_PINNED_PROGRAMS = {}
+# LRU of programs for the paths built at runtime with `{{variable}}` substitution
+JQ_PROGRAMS = collections.OrderedDict()
+JQ_CACHE_STATS = {
+    'hits': 0,
+    'misses': 0,
+}
+REPLACEMENT_REGEX = re.compile(r"{{(.+)}}", re.MULTILINE)
+
+
+# Leading and trailing edge debounce per user: the first call runs right away, calls made within `debounce_seconds`
+# after it are coalesced and only the latest one runs once the window closes. `on_trailing_result` receives its result.
+# Trailing runs are handed to `submit_trailing(user_id, func, *args)` when given, so that they can be queued behind the
+# messages of the same user instead of running concurrently with them.
+def debounce_check_active_tasks(debounce_seconds: int = 1, on_trailing_result=None, submit_trailing=None):
+    # user_id -> {'last_run': timestamp, 'pending': (args, kwargs) or None, 'timer': TimerHandle or None}
+    # Entries are kept in the order of their last run, which is also the order in which their window closes
+    states = collections.OrderedDict()
+    running_tasks = set()
+
+    def prune(now):
+        # Users outside of their window with nothing pending behave as if they were never seen
+        while len(states) > 0:
+            user_id, state = next(iter(states.items()))
+            if state['timer'] is not None or now < state['last_run'] + debounce_seconds:
+                break
+            del states[user_id]
 
-def debounce_check_active_tasks(debounce_seconds: int = 1):
-    func_last_execution_time = {}
     def decorator(func):
+        async def run_trailing(args, kwargs):
+            try:
+                result = await func(*args, **kwargs)
+                if on_trailing_result is not None:
+                    await on_trailing_result(result)
+            except Exception as e:
+                logger.error(f"Error while running debounced `{func.__name__}` for `{args[0]}`: {e}")
+
+        def flush(user_id):
+            state = states[user_id]
+            args, kwargs = state['pending']
+            state['pending'] = None
+            state['timer'] = None
+            state['last_run'] = time.time()
+            states.move_to_end(user_id)
+            if submit_trailing is not None:
+                task = asyncio.ensure_future(submit_trailing(user_id, run_trailing, args, kwargs))
+            else:
+                task = asyncio.ensure_future(run_trailing(args, kwargs))
+            running_tasks.add(task)
+            task.add_done_callback(running_tasks.discard)
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             user_id = args[0]
             now = time.time()
-            key = f"{user_id}_{func.__name__}"
-            if key not in func_last_execution_time:
-                func_last_execution_time[key] = now
-                return func(*args, **kwargs)
-            elif now >= func_last_execution_time[key] + debounce_seconds:
-                func_last_execution_time[key] = now
+            state = states.get(user_id, None)
+            if state is None or (state['timer'] is None and now >= state['last_run'] + debounce_seconds):
+                prune(now)
+                states[user_id] = {'last_run': now, 'pending': None, 'timer': None}
+                states.move_to_end(user_id)
                 return func(*args, **kwargs)
-            else:
-                logger.debug(f">> Debounced for `{user_id}`")
-                return None
+
+            state['pending'] = (args, kwargs,)  # Replaces the message still waiting, if any
+            if state['timer'] is None:
+                delay = max(0, state['last_run'] + debounce_seconds - now)
+                state['timer'] = asyncio.get_running_loop().call_later(delay, flush, user_id)
+            logger.debug(f">> Debounced for `{user_id}`")
+            return None
         return wrapper
     return decorator
 
 
+# Returns the operations `[op, path, value]` transforming `old` into `new`. Nested dicts are compared key by key
+def compute_patch(old, new, path: Union[list, None] = None) -> list:
+    path = [] if path is None else path
+    if type(old) is not dict or type(new) is not dict:
+        return [] if old == new else [['set', path, new]]
+    operations = []
+    for key, value in new.items():
+        if key not in old:
+            operations.append(['set', path + [key], value])
+        else:
+            operations += compute_patch(old[key], value, path + [key])
+    for key in old.keys():
+        if key not in new:
+            operations.append(['del', path + [key]])
+    return operations
+
+
 def eval_data_filtering(inject_evaluation: dict, data: dict, context: dict, debug: bool = False) -> Union[bool, tuple]:
+    conditions = getattr(inject_evaluation, 'conditions', None)  # Compiled at load time for evaluation plans
+    if conditions is None:
+        conditions = compile_conditions(inject_evaluation['parameters'])
     debug_steps = []
     eval_state = None
-    for evaluation_params in inject_evaluation['parameters']:
+    for parameter_conditions in conditions:
         if eval_state is False:
             break
         debug_step = []
-        for evaluation_path, evaluation_config in evaluation_params.items():
+        for condition in parameter_conditions:
             if eval_state is False:
                 break
-            evaluation_path = apply_replacement_from_context(evaluation_path, context)
-            data_to_validate = jq_extract(evaluation_path, data, evaluation_config.get('extract_type', 'first'))
+            evaluation_path = condition.path.render(context)
+            data_to_validate = jq_extract(evaluation_path, data, condition.extract_type)
             debug_step.append({'message': f'Testing `{evaluation_path}`', 'data': {}, 'style': 'primary'})
             cond_satisfied = False
             if data_to_validate is None:
                 debug_step.append({'message': f'The provided path could not extract data', 'data': data, 'style': 'error'})
                 eval_state = False
             else:
-                cond_satisfied = condition_satisfied(evaluation_config, data_to_validate, context)
+                with profiler.phase('condition'):
+                    cond_satisfied = condition.is_satisfied(data_to_validate, context)
             if not cond_satisfied:
                 debug_step.append({'message': f'Condition not satisfied', 'data': {}, 'style': 'fail'})
                 debug_step.append({'message': f'The provided path extracted the following data to validate', 'data': data_to_validate, 'style': ''})
@@ -64,116 +142,251 @@ def eval_data_filtering(inject_evaluation: dict, data: dict, context: dict, debu
 
 # Replace the substring `{{variable}}` by context[variable] or the jq_path in the provided string
 def apply_replacement_from_context(string: str, context: dict) -> str:
-    replacement_regex = r"{{(.+)}}"
-    string = str(string)
-    if r'{{' not in string and r'}}' not in string:
-        return string
-    matches = re.search(replacement_regex, string, re.MULTILINE)
-    if not matches:
-        return string
-    subst_str = matches.groups()[0]
-    subst = context.get(subst_str, None)
-    if subst is None:
-        subst =  jq_extract(subst_str, context)
+    return Template(string).render(context)
+
+
+# A string parsed once for `{{variable}}` substitution
+class Template:
+    __slots__ = ('string', 'variable')
+
+    def __init__(self, string: str):
+        self.string = str(string)
+        self.variable = None
+        if r'{{' in self.string or r'}}' in self.string:
+            matches = REPLACEMENT_REGEX.search(self.string)
+            if matches:
+                self.variable = matches.groups()[0]
+
+    def is_static(self) -> bool:
+        return self.variable is None
+
+    def render(self, context: dict) -> str:
+        if self.variable is None:
+            return self.string
+        subst = context.get(self.variable, None)
         if subst is None:
-            subst = ''
-    return re.sub(replacement_regex, str(subst), string)
+            subst = jq_extract(self.variable, context)
+            if subst is None:
+                subst = ''
+        return REPLACEMENT_REGEX.sub(str(subst), self.string)
+
+
+def get_jq_program(path: str):
+    program = JQ_PINNED_PROGRAMS.get(path, None)
+    if program is None:
+        program = JQ_PROGRAMS.get(path, None)
+        if program is not None:
+            JQ_PROGRAMS.move_to_end(path)
+    if program is not None:
+        JQ_CACHE_STATS['hits'] += 1
+        return program
+
+    JQ_CACHE_STATS['misses'] += 1
+    program = jq.compile(path)
+    JQ_PROGRAMS[path] = program
+    if len(JQ_PROGRAMS) > JQ_CACHE_SIZE:
+        JQ_PROGRAMS.popitem(last=False)
+    return program
+
+
+def pin_jq_program(path: str):
+    program = jq.compile(path)
+    if r'{{' not in path:  # Templated paths are only known after substitution
+        JQ_PINNED_PROGRAMS[path] = program
+    return program
+
+
+def get_jq_cache_stats() -> dict:
+    total = JQ_CACHE_STATS['hits'] + JQ_CACHE_STATS['misses']
+    return {
+        'hits': JQ_CACHE_STATS['hits'],
+        'misses': JQ_CACHE_STATS['misses'],
+        'hit_rate': JQ_CACHE_STATS['hits'] / total if total > 0 else 0,
+        'pinned': len(JQ_PINNED_PROGRAMS),
+        'cached': len(JQ_PROGRAMS),
+        'max_size': JQ_CACHE_SIZE,
+    }
 
 
 def jq_extract(path: str, data: dict, extract_type='first'):
-    try:
-        query = jq.compile(path).input_value(data)
-        return query.first() if extract_type == 'first' else query.all()
-    except StopIteration:
-        return None
-    except ValueError:
-        return None
+    with profiler.phase('jq'):
+        try:
+            query = get_jq_program(path).input_value(data)
+            return query.first() if extract_type == 'first' else query.all()
+        except StopIteration:
+            return None
+        except ValueError:
+            return None
 
 
-def eval_python(inject_evaluation: dict, data: dict, context: dict, debug: bool = False) -> Union[bool, tuple]:
-    return sandboxClient.run(inject_evaluation, data, context, debug)
+async def eval_python(inject_evaluation: dict, data: dict, context: dict, debug: bool = False) -> Union[bool, tuple]:
+    with profiler.phase('sandbox'):
+        return await sandboxClient.run(inject_evaluation, data, context, debug)
+
+
+def compile_conditions(parameters: list) -> list:
+    return [
+        [Condition(evaluation_path, evaluation_config) for evaluation_path, evaluation_config in evaluation_params.items()]
+        for evaluation_params in parameters
+    ]
 
 
 def condition_satisfied(evaluation_config: dict, data_to_validate: Union[dict, list, str], context: dict) -> bool:
-    if type(data_to_validate) is bool:
-        data_to_validate = "1" if data_to_validate else "0"
-    if type(data_to_validate) is str:
-        return eval_condition_str(evaluation_config, data_to_validate, context)
-    elif type(data_to_validate) is list:
-        return eval_condition_list(evaluation_config, data_to_validate, context)
-    elif type(data_to_validate) is dict:
-        # Not sure how we could have condition on this
-        return eval_condition_dict(evaluation_config, data_to_validate, context)
-    return False
-
-
-def eval_condition_str(evaluation_config: dict, data_to_validate: str, context: dict) -> bool:
-    comparison_type = evaluation_config['comparison']
-    values = evaluation_config['values']
-    if len(values) == 0:
-        return False
-    values = [apply_replacement_from_context(v, context) for v in values]
-
-    if comparison_type == 'contains':
-        values = [v.lower() for v in values]
-        data_to_validate = data_to_validate.lower()
-        data_to_validate_set = set(data_to_validate.split())
-        values_set = set(values)
-        intersection = data_to_validate_set & values_set
-        return len(intersection) == len(values_set)
-    elif comparison_type == 'equals':
-        return data_to_validate == values[0]
-    elif comparison_type == 'equals_any':
-        return data_to_validate in values
-    elif comparison_type == 'regex':
-        return re.fullmatch(values[0], data_to_validate)
-    elif comparison_type == 'count':
-        return count_comparison(values, data_to_validate)
-    return False
-
-
-def eval_condition_list(evaluation_config: dict, data_to_validate: str, context: dict) -> bool:
-    comparison_type = evaluation_config['comparison']
-    values = evaluation_config['values']
-
-    if len(values) == 0:
+    return Condition('.', evaluation_config).is_satisfied(data_to_validate, context)
+
+
+# Values of a condition prepared for the comparison. Built once for conditions without `{{variable}}`
+class ConditionValues:
+    __slots__ = ('values', 'values_set', 'values_lower_set', 'regex', 'count_check')
+
+    def __init__(self, comparison_type: str, values: list):
+        self.values = values
+        self.values_set = None
+        self.values_lower_set = None
+        self.regex = None
+        self.count_check = None
+        if len(values) == 0:
+            return
+        if comparison_type in ('contains', 'equals', 'equals_any'):
+            self.values_set = set(values)
+            self.values_lower_set = set([v.lower() for v in values])
+        elif comparison_type in ('regex', 'equals-regex', 'contains-regex'):
+            try:
+                self.regex = re.compile(values[0])
+            except re.error:
+                pass  # Raised again when evaluating
+        elif comparison_type == 'count':
+            self.count_check = compile_count_comparison(values[0])
+
+
+class Condition:
+    __slots__ = ('path', 'extract_type', 'comparison', 'values', 'static_values')
+
+    def __init__(self, evaluation_path: str, evaluation_config: dict):
+        self.path = Template(evaluation_path)
+        self.extract_type = evaluation_config.get('extract_type', 'first')
+        self.comparison = evaluation_config.get('comparison', None)
+        self.values = [Template(v) for v in evaluation_config.get('values', [])]
+        self.static_values = None
+        if all(v.is_static() for v in self.values):
+            self.static_values = ConditionValues(self.comparison, [v.string for v in self.values])
+
+    def get_values(self, context: dict) -> ConditionValues:
+        if self.static_values is not None:
+            return self.static_values
+        return ConditionValues(self.comparison, [v.render(context) for v in self.values])
+
+    def is_satisfied(self, data_to_validate: Union[dict, list, str], context: dict) -> bool:
+        if type(data_to_validate) is bool:
+            data_to_validate = "1" if data_to_validate else "0"
+        if type(data_to_validate) is str:
+            return self.eval_str(data_to_validate, context)
+        elif type(data_to_validate) is list:
+            return self.eval_list(data_to_validate, context)
+        elif type(data_to_validate) is dict:
+            # Not sure how we could have condition on this
+            return self.eval_dict(data_to_validate, context)
         return False
-    values = [apply_replacement_from_context(v, context) for v in values]
 
-    if comparison_type == 'contains' or comparison_type == 'equals':
-        data_to_validate_set = set(data_to_validate)
-        values_set = set(values)
-        intersection = data_to_validate_set & values_set
+    def eval_str(self, data_to_validate: str, context: dict) -> bool:
+        comparison_type = self.comparison
+        prepared = self.get_values(context)
+        values = prepared.values
+        if len(values) == 0:
+            return False
+
         if comparison_type == 'contains':
-            return len(intersection) == len(values_set)
+            data_to_validate_set = set(data_to_validate.lower().split())
+            intersection = data_to_validate_set & prepared.values_lower_set
+            return len(intersection) == len(prepared.values_lower_set)
         elif comparison_type == 'equals':
-            return len(intersection) == len(values_set) and len(intersection) == len(data_to_validate_set)
-    if comparison_type == 'equals-regex':
-        regex = re.compile(values[0])
-        for candidate in data_to_validate:
-            if regex.match(candidate) is None:
-                return False
-            else:
-                return True
+            return data_to_validate == values[0]
+        elif comparison_type == 'equals_any':
+            return data_to_validate in prepared.values_set
+        elif comparison_type == 'regex':
+            regex = prepared.regex if prepared.regex is not None else re.compile(values[0])
+            return regex.fullmatch(data_to_validate) is not None
+        elif comparison_type == 'count':
+            return check_count(prepared, data_to_validate)
         return False
-    if comparison_type == 'contains-regex':
-        regex = re.compile(values[0])
-        for candidate in data_to_validate:
-            if regex.match(candidate) is not None:
-                return True
+
+    def eval_list(self, data_to_validate: list, context: dict) -> bool:
+        comparison_type = self.comparison
+        prepared = self.get_values(context)
+        values = prepared.values
+        if len(values) == 0:
+            return False
+
+        if comparison_type == 'contains' or comparison_type == 'equals':
+            data_to_validate_set = set(data_to_validate)
+            intersection = data_to_validate_set & prepared.values_set
+            if comparison_type == 'contains':
+                return len(intersection) == len(prepared.values_set)
+            elif comparison_type == 'equals':
+                return len(intersection) == len(prepared.values_set) and len(intersection) == len(data_to_validate_set)
+        if comparison_type == 'equals-regex':
+            regex = prepared.regex if prepared.regex is not None else re.compile(values[0])
+            for candidate in data_to_validate:
+                if regex.match(candidate) is None:
+                    return False
+                else:
+                    return True
+            return False
+        if comparison_type == 'contains-regex':
+            regex = prepared.regex if prepared.regex is not None else re.compile(values[0])
+            for candidate in data_to_validate:
+                if regex.match(candidate) is not None:
+                    return True
+            return False
+        elif comparison_type == 'count':
+            return check_count(prepared, data_to_validate)
+        return False
+
+    def eval_dict(self, data_to_validate: dict, context: dict) -> bool:
+        prepared = self.get_values(context)
+        if len(prepared.values) == 0:
+            return False
+
+        if self.comparison == 'count':
+            return check_count(prepared, data_to_validate)
         return False
-    elif comparison_type == 'count':
-        return count_comparison(values, data_to_validate)
-    return False
+
+
+def check_count(prepared: ConditionValues, data_to_validate: Union[dict, list, str]) -> bool:
+    if prepared.count_check is not None:
+        return prepared.count_check(len(data_to_validate))
+    return count_comparison(prepared.values, data_to_validate)
+
+
+COUNT_COMPARATORS = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '=': operator.eq,
+}
+
+
+def compile_count_comparison(value: str):
+    try:
+        if value.isdigit():
+            expected = int(value)
+            return lambda count: count == expected
+        elif value[:2] in COUNT_COMPARATORS.keys():
+            comparator = COUNT_COMPARATORS[value[:2]]
+            expected = int(value[2:])
+            return lambda count: comparator(count, expected)
+        elif value[0] in COUNT_COMPARATORS.keys():
+            comparator = COUNT_COMPARATORS[value[0]]
+            expected = int(value[1:])
+            return lambda count: comparator(count, expected)
+        return lambda count: False
+    except (ValueError, IndexError):
+        return None  # Raised again when evaluating
+
 
 def count_comparison(values: str, data_to_validate: str) -> bool:
-    comparators = {
-        '<': operator.lt,
-        '<=': operator.le,
-        '>': operator.gt,
-        '>=': operator.ge,
-        '=': operator.eq,
-    }
+    comparators = COUNT_COMPARATORS
     value = values[0]
     if value.isdigit():
         value = int(value)
@@ -190,26 +403,8 @@ def count_comparison(values: str, data_to_validate: str) -> bool:
         return comparators[value_operator](count, value)
 
 
-def eval_condition_dict(evaluation_config: dict, data_to_validate: str, context: dict) -> bool:
-    comparison_type = evaluation_config['comparison']
-    values = evaluation_config['values']
-    comparators = {
-        '<': operator.lt,
-        '<=': operator.le,
-        '>': operator.gt,
-        '>=': operator.ge,
-        '=': operator.eq,
-    }
-
-    if len(values) == 0:
-        return False
-    values = [apply_replacement_from_context(v, context) for v in values]
-
-    comparison_type = evaluation_config['comparison']
-    if comparison_type == 'contains':
-        pass
-    elif comparison_type == 'equals':
-        pass
-    elif comparison_type == 'count':
-        return count_comparison(values, data_to_validate)
-    return False
+def get_version() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
@@ -0,0 +1,18 @@
+// Applies the operations computed by `compute_patch()` in backend/utils.py and returns the patched root.
+// Kept free of imports so that tests/test_progress_patch.py can run it with node.
+export function applyPatch(root, operations) {
+  operations.forEach(([op, path, value]) => {
+    if (path.length === 0) {
+      root = value
+      return
+    }
+    const parent = path.slice(0, -1).reduce((node, key) => node[key], root)
+    const key = path[path.length - 1]
+    if (op === 'set') {
+      parent[key] = value
+    } else if (op === 'del') {
+      delete parent[key]
+    }
+  })
+  return root
+}
@@ -1,6 +1,7 @@
 import { reactive, computed } from 'vue'
 import { io } from 'socket.io-client'
 import { toast } from '@/utils'
+import { applyPatch } from '@/progressPatch'
 import debounce from 'lodash.debounce'
 
 // "undefined" means the URL will be computed from the `window.location` object
@@ -18,6 +19,7 @@ const initial_state = {
   exercises: [],
   selected_exercises: [],
   progresses: {},
+  progressVersion: 0,
   userTaskCheckInProgress: {},
   userStats: {},
   diagnostic: {},
@@ -173,13 +175,20 @@ function getNotifications() {
 }
 
 function getProgress() {
-  socket.emit('get_progress', (all_progress) => {
-    // all_progress = Array(20).fill().map(item => (all_progress[1]))
-    state.progresses = all_progress
+  socket.emit('get_progress_snapshot', (snapshot) => {
+    state.progresses = snapshot.progress
+    state.userStats = snapshot.statistics
+    state.progressVersion = snapshot.version
     updateTaskCheckInProgress()
   })
 }
 
+function applyProgressPatch(operations) {
+  const root = applyPatch({ progress: state.progresses, statistics: state.userStats }, operations)
+  state.progresses = root.progress
+  state.userStats = root.statistics
+}
+
 function updateTaskCheckInProgress() {
   Object.keys(state.progresses).forEach(user_id => {
     Object.values(state.progresses[user_id].exercises).forEach(exercise => {
@@ -372,6 +381,9 @@ socket.on('refresh_score', () => {
 
 socket.on('keep_alive', (keep_alive) => {
   connectionState.zmq_last_time = keep_alive['zmq_last_time']
+  if (keep_alive['progress_version'] !== undefined && keep_alive['progress_version'] !== state.progressVersion) {
+    debouncedGetProgress()
+  }
 })
 
 socket.on('update_notification_history', (notification_history_bundle) => {
@@ -384,13 +396,21 @@ socket.on('update_users_activity', (user_activity_bundle) => {
   state.userActivityConfig = user_activity_bundle.config
 })
 
-socket.on('update_progress', (all_progress) => {
-  state.progresses = all_progress
+socket.on('progress_patch', ({ base_version, version, operations }) => {
+  if (base_version !== state.progressVersion) {
+    // Missed a patch, resynchronize from a full snapshot
+    debouncedGetProgress()
+    return
+  }
+  applyProgressPatch(operations)
+  state.progressVersion = version
   updateTaskCheckInProgress()
 })
 
-socket.on('update_statistics', (user_stats) => {
-  state.userStats = user_stats
+socket.on('progress_version', ({ version }) => {
+  if (version !== state.progressVersion) {
+    debouncedGetProgress()
+  }
 })
 
 
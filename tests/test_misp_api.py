@@ -0,0 +1,46 @@
+import asyncio
+
+from backend import misp_api
+
+# Results of `coalesced_query()` and of the response cache are shared between callers. Mutating one of them must not
+# change what the others get.
+
+
+def test_coalesced_query_returns_a_copy_per_caller(monkeypatch):
+    performed = []
+
+    async def get(url, data={}, api_key=None):
+        performed.append(url)
+        await asyncio.sleep(0.01)
+        return {'Event': {'Attribute': [{'value': '8.8.8.8'}]}}
+
+    monkeypatch.setattr(misp_api, 'get', get)
+
+    async def run():
+        with misp_api.fetch_scope():
+            first, second = await asyncio.gather(
+                misp_api.coalesced_query('GET', '/events/view/1', api_key='key'),
+                misp_api.coalesced_query('GET', '/events/view/1', api_key='key'),
+            )
+            first['Event']['Attribute'].clear()
+            third = await misp_api.coalesced_query('GET', '/events/view/1', api_key='key')
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert performed == ['/events/view/1']
+    assert first == {'Event': {'Attribute': []}}
+    assert second == third == {'Event': {'Attribute': [{'value': '8.8.8.8'}]}}
+
+
+def test_response_cache_returns_a_copy_per_hit():
+    cache = misp_api.MemoryResponseCache()
+    response = {'response': [{'Event': {'id': '1'}}]}
+
+    async def run():
+        await cache.set(('GET', '/events/index', 'key', 'null'), response)
+        response['response'].clear()
+        first = await cache.get(('GET', '/events/index', 'key', 'null'))
+        first['response'].clear()
+        return await cache.get(('GET', '/events/index', 'key', 'null'))
+
+    assert asyncio.run(run()) == {'response': [{'Event': {'id': '1'}}]}
@@ -0,0 +1,86 @@
+import json
+import pathlib
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from backend.utils import compute_patch
+
+# Every client rebuilds its view by applying the operations of `compute_patch()` with `applyPatch()` from
+# src/progressPatch.js. Random sequences of states are patched with node and must match the server state.
+
+PATCH_MODULE = pathlib.Path(__file__).resolve().parent.parent / 'src' / 'progressPatch.js'
+NODE_SCRIPT = f'''
+import {{ applyPatch }} from '{PATCH_MODULE.as_uri()}'
+let input = ''
+process.stdin.on('data', (chunk) => {{ input += chunk }})
+process.stdin.on('end', () => {{
+  const results = JSON.parse(input).map((sequence) => {{
+    let root = null
+    return sequence.map((operations) => {{
+      root = applyPatch(root, operations)
+      return JSON.parse(JSON.stringify(root))
+    }})
+  }})
+  process.stdout.write(JSON.stringify(results))
+}})
+'''
+
+pytestmark = pytest.mark.skipif(shutil.which('node') is None, reason='node is required to run src/progressPatch.js')
+
+
+def generate_value(generator: random.Random, depth: int):
+    kind = generator.random()
+    if depth > 0 and kind < 0.5:
+        return {str(generator.randint(0, 6)): generate_value(generator, depth - 1) for _ in range(generator.randint(0, 4))}
+    if kind < 0.6:
+        return [generator.randint(0, 3) for _ in range(generator.randint(0, 3))]
+    if kind < 0.7:
+        return None
+    if kind < 0.8:
+        return generator.choice([True, False])
+    if kind < 0.9:
+        return generator.choice(['', 'a', 'b'])
+    return generator.randint(0, 3)
+
+
+# Shaped like the output of `get_progress()` and `get_users_stats()`
+def generate_progress_state(generator: random.Random) -> dict:
+    progress = {}
+    statistics = {}
+    for user_id in generator.sample(range(1, 13), generator.randint(0, 6)):
+        tasks_completion = {f"task-{t}": generator.choice([False, {'timestamp': generator.randint(0, 5), 'first_completion': generator.random() < 0.2}]) for t in range(generator.randint(0, 4))}
+        progress[str(user_id)] = {
+            'email': f"user{user_id}@admin.test",
+            'exercises': {'exercise-1': {'tasks_completion': tasks_completion, 'score': generator.randint(0, 100)}},
+        }
+        statistics[str(user_id)] = {'on_fire': generator.random() < 0.3, 'trophies': generator.sample(['first_blood', 'speed_runner', 'chatty'], generator.randint(0, 3))}
+    return {'progress': progress, 'statistics': statistics}
+
+
+def apply_with_node(patches: list) -> list:
+    result = subprocess.run(['node', '--input-type=module', '-e', NODE_SCRIPT], input=json.dumps(patches), capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def get_patches(sequence: list) -> list:
+    patches = []
+    previous = None
+    for state in sequence:
+        # Same as `update_progress_state()`: the first state is sent as a whole
+        patches.append([['set', [], state]] if previous is None else compute_patch(previous, state))
+        previous = state
+    return patches
+
+
+@pytest.mark.parametrize('generate_state', [
+    generate_progress_state,
+    lambda generator: {'progress': generate_value(generator, 4), 'statistics': generate_value(generator, 3)},
+], ids=['progress', 'arbitrary'])
+def test_patches_rebuild_the_server_state(generate_state):
+    generator = random.Random(0)
+    sequences = [[generate_state(generator) for _ in range(10)] for _ in range(200)]
+    rebuilt = apply_with_node([get_patches(sequence) for sequence in sequences])
+    assert rebuilt == sequences